@@ -280,7 +280,10 @@ class TrainingWorker(QThread):
 
     def answer_question(self, question, timeout=2):
         try:
-            resp = requests.post(f"{SERVER_URL}/chat", json={"messages": [{"role": "user", "content": question}], "query": question}, timeout=timeout)
+            # Background priority: the server serves interactive chats first and drops
+            # this request if it is still queued when we stop waiting for it
+            resp = requests.post(f"{SERVER_URL}/chat", json={"messages": [{"role": "user", "content": question}], "query": question,
+                                                             "priority": "background", "timeout": timeout}, timeout=timeout)
             if resp.status_code == 200:
                 return resp.json().get("response", "[No answer]")
             return "[No answer]"
@@ -71,10 +71,15 @@ class StreamingChatWorker(QThread):
         self.cyber_mode = cyber_mode
         self.prefs = None
         self._is_running = True
+        self._response = None
         self.user_id = USER_ID
         
     def stop(self):
         self._is_running = False
+        # Closing the connection tells the server to stop generating right away
+        response = self._response
+        if response is not None:
+            response.close()
         
     def run(self):
         try:
@@ -105,6 +110,7 @@ class StreamingChatWorker(QThread):
                     stream=True,
                     timeout=30
                 )
+                self._response = response
                 
                 if response.status_code != 200:
                     self.error_signal.emit(f"Error: {response.status_code} - {response.text}")
@@ -164,10 +170,15 @@ class StreamingChatWorker(QThread):
         except requests.exceptions.Timeout:
             self.error_signal.emit("Request timed out. Please try again.")
         except requests.exceptions.ConnectionError:
-            self.error_signal.emit("Could not connect to server. Please check if the server is running.")
+            # stop() closes the connection under us; that is not an error
+            if self._is_running:
+                self.error_signal.emit("Could not connect to server. Please check if the server is running.")
         except Exception as e:
-            logger.error(f"Streaming chat worker error: {str(e)}")
-            self.error_signal.emit(str(e))
+            if self._is_running:
+                logger.error(f"Streaming chat worker error: {str(e)}")
+                self.error_signal.emit(str(e))
+        finally:
+            self._response = None
 
 class LogMonitorWorker(QThread):
     log_signal = pyqtSignal(str)
@@ -12,12 +12,18 @@ import glob
 import chromadb
 from chromadb.config import Settings
 from chromadb.errors import InternalError
-from pypdf import PdfReader
 import requests
 import sys
 import traceback
 from pathlib import Path
 import logging
+import json
+from server.semantic_cache import bump_kb_version
+from server.embeddings import create_embedder
+from server.storage import open_storage
+from server.retention import ChatArchive, RetentionManager
+from server.summarizer import shift_summary
+from server.ingest import IngestPipeline
 
 # Set up logging
 logging.basicConfig(
@@ -36,6 +42,31 @@ MODEL_PATH = "./models/mistral-7b-instruct/mistral-7b-instruct-v0.2.Q4_K_M.gguf"
 KNOWLEDGE_FOLDER = "./knowledge"
 CHROMA_DB_FOLDER = "./chroma_db"
 BACKUP_FOLDER = "./chroma_db_backups"
+# Shared with llm_server.py; bumping it invalidates the server's cached answers
+KB_VERSION_FILE = "./chroma_db.version"
+# Must match the server's MEAI_EMBED_MODEL_PATH so ingested vectors and queries agree
+EMBED_MODEL_PATH = os.environ.get("MEAI_EMBED_MODEL_PATH")
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "Local-LLM"
+# Same storage backend settings as the server (MEAI_STORAGE = "mongo" or "sqlite")
+STORAGE_BACKEND = os.environ.get("MEAI_STORAGE", "mongo")
+SQLITE_PATH = os.environ.get("MEAI_SQLITE_PATH", "./meai.db")
+# Ingestion pipeline: chunks embedded and written per batch, and file reader threads
+INGEST_BATCH = int(os.environ.get("MEAI_INGEST_BATCH", "64"))
+INGEST_READERS = int(os.environ.get("MEAI_INGEST_READERS", "2"))
+# Same retention policy as the server (days kept hot per collection, 0 = forever)
+RETENTION_DAYS = json.loads(os.environ.get("MEAI_RETENTION_DAYS", '{"chat_history": 30}'))
+CHAT_ARCHIVE_DIR = os.environ.get("MEAI_CHAT_ARCHIVE_DIR", "./chat_archive")
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("MEAI_ARCHIVE_RETENTION_DAYS", "0"))
+
+_embedder = None
+
+def get_embedder():
+    """The shared embedding model, loaded on first use."""
+    global _embedder
+    if _embedder is None:
+        _embedder = create_embedder(EMBED_MODEL_PATH)
+    return _embedder
 
 def backup_chroma_db(reason="manual"):
     """
@@ -119,6 +150,7 @@ def restore_chroma_db_from_backup(backup_path=None):
         
         # Restore from backup
         shutil.copytree(backup_path, CHROMA_DB_FOLDER)
+        bump_kb_version(KB_VERSION_FILE)
         console.print(f"[bold green]Successfully restored ChromaDB from: {backup_path}[/bold green]")
         logger.info(f"Restored ChromaDB from backup: {backup_path}")
         return True
@@ -257,7 +289,9 @@ def train(data_path: str = None):
     console.print("[bold yellow]Local fine-tuning is a resource-intensive process. This feature is under development.[/bold yellow]")
 
 @cli.command()
-def ingest():
+@click.option('--batch-size', default=INGEST_BATCH, show_default=True, help="Chunks embedded and written per call.")
+@click.option('--readers', default=INGEST_READERS, show_default=True, help="Threads reading and extracting files.")
+def ingest(batch_size, readers):
     """Recursively ingest all PDFs, text, markdown, and code files in the knowledge folder into the local vector DB."""
     console.print(f"[bold blue]Recursively ingesting documents and code from {KNOWLEDGE_FOLDER}...[/bold blue]")
     
@@ -270,14 +304,11 @@ def ingest():
         # Get a robust ChromaDB client with recovery mechanisms
         client = get_chroma_client()
         collection = client.get_or_create_collection("knowledge")
-        # Fetch all existing IDs for deduplication
-        existing_ids = set(collection.get()["ids"])
         # File extensions to ingest
         doc_exts = [".pdf", ".txt", ".md"]
         code_exts = [
             ".py", ".sh", ".bat", ".ps1", ".c", ".cpp", ".go", ".js", ".rb", ".pl", ".php", ".java", ".cs", ".yaml", ".yml", ".json", ".toml", ".ini", ".conf", ".xml", ".html", ".ts"
         ]
-        all_exts = doc_exts + code_exts
         doc_files = []
         code_files = []
         for p in Path(KNOWLEDGE_FOLDER).rglob("*"):
@@ -287,73 +318,31 @@ def ingest():
                     doc_files.append(p)
                 elif ext in code_exts:
                     code_files.append(p)
-        total_chunks = 0
-        code_chunks = 0
-        failed_files = []
-        # Ingest document files
-        for file_path in doc_files:
-            file_path = str(file_path)
-            try:
-                if file_path.lower().endswith(".pdf"):
-                    reader = PdfReader(file_path)
-                    text = "\n".join(page.extract_text() or "" for page in reader.pages)
-                else:
-                    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                        text = f.read()
-                # Split into chunks for embedding
-                chunks = [text[i:i+1000] for i in range(0, len(text), 1000) if text[i:i+1000].strip()]
-                new_chunks = 0
-                for idx, chunk in enumerate(chunks):
-                    chunk_id = f"{file_path}-{idx}"
-                    if chunk_id in existing_ids:
-                        continue  # Skip already ingested chunk
-                    collection.add(
-                        documents=[chunk],
-                        metadatas=[{"source": file_path, "chunk": idx}],
-                        ids=[chunk_id]
-                    )
-                    existing_ids.add(chunk_id)
-                    new_chunks += 1
-                total_chunks += new_chunks
-                if new_chunks > 0:
-                    console.print(f"[green]Ingested:[/green] {file_path} ([cyan]{new_chunks} new chunks[/cyan])")
-                else:
-                    console.print(f"[yellow]Skipped (already ingested):[/yellow] {file_path}")
-            except Exception as e:
-                failed_files.append(file_path)
-                console.print(f"[red]Failed to ingest:[/red] {file_path} - {e}")
-                traceback.print_exc()
-        # Ingest code files
-        for file_path in code_files:
-            file_path = str(file_path)
-            try:
-                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                    text = f.read()
-                # Split into chunks for embedding
-                chunks = [text[i:i+1000] for i in range(0, len(text), 1000) if text[i:i+1000].strip()]
-                new_chunks = 0
-                for idx, chunk in enumerate(chunks):
-                    chunk_id = f"{file_path}-{idx}"
-                    if chunk_id in existing_ids:
-                        continue  # Skip already ingested chunk
-                    collection.add(
-                        documents=[chunk],
-                        metadatas=[{"source": file_path, "chunk": idx, "type": "code"}],
-                        ids=[chunk_id]
-                    )
-                    existing_ids.add(chunk_id)
-                    new_chunks += 1
-                code_chunks += new_chunks
-                total_chunks += new_chunks
-                if new_chunks > 0:
-                    console.print(f"[blue]Ingested code:[/blue] {file_path} ([cyan]{new_chunks} new chunks[/cyan])")
-                else:
-                    console.print(f"[yellow]Skipped code (already ingested):[/yellow] {file_path}")
-            except Exception as e:
-                failed_files.append(file_path)
-                console.print(f"[red]Failed to ingest code:[/red] {file_path} - {e}")
-                traceback.print_exc()
-        console.print(f"[bold green]Ingestion complete. {len(doc_files)} document files, {len(code_files)} code files processed, {total_chunks} new chunks ({code_chunks} new code chunks) added.[/bold green]")
+
+        def on_file(file_path, new_chunks, metadata):
+            label = "code" if metadata.get("type") == "code" else "document"
+            if new_chunks > 0:
+                console.print(f"[green]Queued {label}:[/green] {file_path} ([cyan]{new_chunks} new chunks[/cyan])")
+            else:
+                console.print(f"[yellow]Skipped {label} (already ingested):[/yellow] {file_path}")
+
+        def on_error(file_path, error):
+            console.print(f"[red]Failed to ingest:[/red] {file_path} - {error}")
+
+        # Readers, chunker and a batching embedder/writer run concurrently
+        pipeline = IngestPipeline(collection, get_embedder(), batch_size=batch_size, readers=readers,
+                                  on_file=on_file, on_error=on_error)
+        files = [(str(p), {}) for p in doc_files] + [(str(p), {"type": "code"}) for p in code_files]
+        report = pipeline.run(files)
+        total_chunks = report["chunks"]
+        failed_files = report["failed_files"]
+        if total_chunks:
+            bump_kb_version(KB_VERSION_FILE)
+        console.print(f"[bold green]Ingestion complete. {len(doc_files)} document files, {len(code_files)} code files processed, {total_chunks} new chunks added.[/bold green]")
+        console.print(f"[bold blue]Throughput:[/bold blue] {report['chunks_per_second']} chunks/sec "
+                      f"({report['seconds']}s total; reading {report['read_seconds']}s, embedding "
+                      f"{report['embed_seconds']}s, writing {report['write_seconds']}s; {report['batches']} batches "
+                      f"of up to {batch_size})")
         if failed_files:
             console.print(f"[bold red]Failed files ({len(failed_files)}):[/bold red]")
             for f in failed_files:
@@ -415,6 +404,97 @@ def backup():
     else:
         console.print("[bold red]Backup failed.[/bold red]")
 
+@cli.command()
+@click.option('--explain/--no-explain', default=True, help="Report query plans for the hot queries.")
+@click.option('--user-id', default="default", help="User whose chat history the plans are explained for.")
+def migrate(explain, user_id):
+    """Apply database migrations, create missing indexes and explain the hot queries."""
+    storage = None
+    try:
+        storage = open_storage(STORAGE_BACKEND, mongo_uri=MONGO_URI, db_name=DB_NAME, sqlite_path=SQLITE_PATH)
+        console.print(f"[bold blue]Migrating {storage.name} storage...[/bold blue]")
+        report = storage.migrate()
+        for name, result in report["migrations"].items():
+            console.print(f"[green]Applied {name}:[/green] {result}")
+        if report["indexes_created"]:
+            console.print(f"[green]Created indexes:[/green] {', '.join(report['indexes_created'])}")
+        else:
+            console.print("[green]All indexes already present.[/green]")
+        if explain:
+            console.print("[bold blue]Hot query plans:[/bold blue]")
+            for name, plan in storage.explain(user_id).items():
+                color = "red" if plan["collection_scan"] else "green"
+                details = [f"index: {plan['index'] or 'none'}"] + [
+                    f"{label}: {plan[field]}" for label, field in
+                    (("keys examined", "keys_examined"), ("docs examined", "docs_examined"), ("returned", "returned"),
+                     ("ms", "ms"))
+                    if plan[field] is not None
+                ]
+                console.print(f"  [{color}]{name}[/{color}]: {' <- '.join(s for s in plan['stages'] if s)} "
+                              f"({', '.join(details)})")
+    except Exception as e:
+        logger.error(f"Migration failed: {e}")
+        console.print(f"[bold red]Migration failed: {e}[/bold red]")
+    finally:
+        if storage is not None:
+            storage.close()
+
+def _server_running():
+    try:
+        return requests.get("http://127.0.0.1:8000/health", timeout=2).ok
+    except requests.RequestException:
+        return False
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+@cli.command()
+@click.option('--compact/--report-only', default=False, help="Apply the retention policy before reporting.")
+def retention(compact):
+    """Archive and expire data past its retention period, and report storage savings."""
+    storage = None
+    try:
+        storage = open_storage(STORAGE_BACKEND, mongo_uri=MONGO_URI, db_name=DB_NAME, sqlite_path=SQLITE_PATH)
+        archive = ChatArchive(CHAT_ARCHIVE_DIR)
+        console.print(f"[bold blue]Retention policy (days):[/bold blue] {RETENTION_DAYS}, "
+                      f"archive: {ARCHIVE_RETENTION_DAYS or 'forever'}")
+        if compact and _server_running():
+            # Its cached history windows and summary offsets would be written back stale
+            console.print("[bold yellow]The server is running and compacts on its own schedule "
+                          "(MEAI_RETENTION_INTERVAL); stop it to compact from here. Reporting only.[/bold yellow]")
+            compact = False
+        if compact:
+            # Summaries count the messages they cover; archived ones no longer count
+            manager = RetentionManager(storage, archive, RETENTION_DAYS, archive_days=ARCHIVE_RETENTION_DAYS,
+                                       on_archived=lambda user_id, count: shift_summary(storage, user_id, count))
+            report = manager.run_once()
+            console.print(f"[green]Archived {report['archived_messages']} messages into "
+                          f"{report['segments_written']} segments "
+                          f"({_format_bytes(report['raw_bytes'])} -> {_format_bytes(report['stored_bytes'])}), "
+                          f"expired {report['segments_expired']} segments in {report['seconds']}s[/green]")
+            for collection, deleted in report["deleted"].items():
+                console.print(f"[green]Deleted {deleted} expired {collection} documents[/green]")
+        console.print(f"[bold blue]Hot collections ({storage.name}):[/bold blue]")
+        for collection, info in sorted(storage.collection_stats().items()):
+            console.print(f"  {collection}: {info['count']} documents, {_format_bytes(info['bytes'])}")
+        stats = archive.stats()
+        console.print(f"[bold blue]Chat archive ({CHAT_ARCHIVE_DIR}):[/bold blue] {stats['segments']} segments "
+                      f"for {stats['users']} users")
+        if stats["raw_bytes"]:
+            saved = stats["raw_bytes"] - stats["stored_bytes"]
+            console.print(f"  {_format_bytes(stats['raw_bytes'])} of messages stored in "
+                          f"{_format_bytes(stats['stored_bytes'])}: {_format_bytes(saved)} saved "
+                          f"({saved / stats['raw_bytes']:.0%}, {stats['compression_ratio']}x)")
+    except Exception as e:
+        logger.error(f"Retention failed: {e}")
+        console.print(f"[bold red]Retention failed: {e}[/bold red]")
+    finally:
+        if storage is not None:
+            storage.close()
+
 @cli.command()
 def build():
     """Build and launch the MeAI desktop app."""
@@ -445,7 +525,7 @@ def retrieve_context(query, top_k=3):
     try:
         client = get_chroma_client()
         collection = client.get_or_create_collection("knowledge")
-        results = collection.query(query_texts=[query], n_results=top_k)
+        results = collection.query(query_embeddings=get_embedder()([query]), n_results=top_k)
         docs = [doc for doc in results.get("documents", [[]])[0]]
         return "\n".join(docs)
     except Exception as e:
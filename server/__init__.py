@@ -0,0 +1,3 @@
+"""
+MeAI Server Package
+"""
@@ -0,0 +1,187 @@
+"""
+Admission control for generation requests.
+
+Requests that cannot get a sequence slot right away wait in a bounded
+priority queue. Interactive chats are always admitted before background
+work such as the self-training loop, and background requests may only fill
+part of the queue so there is always room for a real user. Anything past the
+limit is rejected immediately with a retry hint instead of piling up, and a
+request whose deadline passes while it is queued is dropped without ever
+being decoded.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "background": PRIORITY_BACKGROUND}
+
+# Share of the queue background requests may occupy
+BACKGROUND_SHARE = 0.5
+
+
+class QueueFull(Exception):
+    """Raised when a request cannot be queued; retry_after is a hint in seconds."""
+
+    def __init__(self, retry_after, message="Generation queue is full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueTimeout(TimeoutError):
+    """Set as the error of a request whose deadline passed before it was admitted."""
+
+
+def parse_priority(value):
+    """Map a priority name (or number) to its queue rank; unknown values are interactive."""
+    if isinstance(value, int):
+        return value
+    return PRIORITIES.get(str(value).lower(), PRIORITY_INTERACTIVE)
+
+
+def priority_limit(priority, max_depth):
+    """How many requests may be queued ahead of a new request of this priority."""
+    if priority <= PRIORITY_INTERACTIVE:
+        return max_depth
+    return max(1, int(max_depth * BACKGROUND_SHARE))
+
+
+def estimate_retry_after(depth, n_servers, service_time):
+    """Seconds until a queue of `depth` drains through n_servers at service_time each."""
+    if not service_time:
+        return 1
+    return max(1, math.ceil(service_time * (depth + 1) / max(1, n_servers)))
+
+
+class AdmissionQueue:
+    """
+    Bounded priority queue of requests waiting for a slot.
+
+    Items need `priority` and `deadline` (absolute time or None) attributes
+    and a `_finish(reason, error)` method, as GenerationRequest has.
+
+    Args:
+        max_depth: Maximum number of queued requests
+        n_servers: Requests served concurrently, used for retry estimates
+    """
+
+    def __init__(self, max_depth=16, n_servers=1):
+        self.max_depth = max_depth
+        self.n_servers = n_servers
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._waits = deque(maxlen=256)
+        self._service_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, request):
+        """
+        Queue a request, or raise QueueFull if its priority's share is used up.
+
+        Once the queue is closed, the request is finished with an error instead,
+        so nothing can be queued after the final drain() and wait forever.
+        """
+        with self._cond:
+            if self._closed:
+                request._finish("error", RuntimeError("Scheduler is shut down"))
+                return
+            self._expire()
+            limit = priority_limit(request.priority, self.max_depth)
+            if len(self._heap) >= limit:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            heapq.heappush(self._heap, (request.priority, next(self._order), request))
+            self._cond.notify()
+
+    def get(self, block=True):
+        """Pop the most urgent live request; None when empty (non-blocking) or closed."""
+        with self._cond:
+            while True:
+                self._expire()
+                if self._heap:
+                    _, _, request = heapq.heappop(self._heap)
+                    self._waits.append(time.time() - request.submitted_at)
+                    self.admitted += 1
+                    return request
+                if not block or self._closed:
+                    return None
+                # Wake up now and then so queued deadlines are enforced while idle
+                self._cond.wait(timeout=1.0)
+
+    def discard(self, request):
+        """Drop a request that is still queued; returns False if it was already taken."""
+        with self._cond:
+            for i, item in enumerate(self._heap):
+                if item[2] is request:
+                    self._heap[i] = self._heap[-1]
+                    self._heap.pop()
+                    heapq.heapify(self._heap)
+                    return True
+            return False
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def drain(self):
+        """Remove and return everything still queued."""
+        with self._cond:
+            requests = [item[2] for item in self._heap]
+            self._heap.clear()
+            return requests
+
+    def _expire(self):
+        now = time.time()
+        if not any(r.deadline is not None and r.deadline <= now for _, _, r in self._heap):
+            return
+        live = []
+        for item in self._heap:
+            request = item[2]
+            if request.deadline is not None and request.deadline <= now:
+                self.expired += 1
+                request._finish("expired", QueueTimeout("Request deadline passed while waiting in the generation queue"))
+            else:
+                live.append(item)
+        heapq.heapify(live)
+        self._heap = live
+
+    def record_service(self, seconds):
+        """Feed how long an admitted request held its slot (for Retry-After estimates)."""
+        if self._service_time:
+            self._service_time = 0.9 * self._service_time + 0.1 * seconds
+        else:
+            self._service_time = seconds
+
+    def retry_after(self):
+        return estimate_retry_after(len(self._heap), self.n_servers, self._service_time)
+
+    def stats(self):
+        with self._cond:
+            queued = [p for p, _, _ in self._heap]
+            waits = np.array(self._waits) if self._waits else None
+        by_priority = {name: queued.count(rank) for name, rank in PRIORITIES.items()}
+        return {
+            "depth": len(queued),
+            "max_depth": self.max_depth,
+            "queued": by_priority,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "wait_ms_avg": round(float(waits.mean()) * 1000, 1) if waits is not None else 0.0,
+            "wait_ms_p95": round(float(np.percentile(waits, 95)) * 1000, 1) if waits is not None else 0.0,
+            "retry_after": self.retry_after(),
+        }
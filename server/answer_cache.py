@@ -0,0 +1,91 @@
+"""
+In-process exact-match answer cache.
+
+The first stop for every chat: a dictionary lookup keyed by a hash of the
+normalized query plus the options that shape the answer. A hit skips Mongo,
+Chroma and the model entirely. The cache is warmed at startup from answers
+users upvoted.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    return _WHITESPACE.sub(" ", (query or "").strip().lower()).rstrip(" ?!.")
+
+
+def answer_key(query, **options):
+    """Cache key for a query under the given answer-shaping options."""
+    payload = json.dumps([normalize_query(query), options], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    LRU of answers with a time-to-live.
+
+    Args:
+        max_entries: Answers kept before the least recently used is dropped
+        ttl: Seconds an answer stays valid
+    """
+
+    def __init__(self, max_entries=2048, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, answer, created_at=None):
+        with self._lock:
+            self._entries[key] = (answer, created_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def warm(self, items):
+        """Load (key, answer) pairs, oldest first so the newest end up most recently used."""
+        for key, answer in items:
+            self.put(key, answer)
+            self.warmed += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "warmed": self.warmed,
+        }
@@ -0,0 +1,135 @@
+"""
+Long-term semantic chat memory.
+
+Every finished exchange (the user's message and the assistant's answer) is
+embedded into a vector index of its own user, kept in a dedicated Chroma
+database. When a prompt is built, the past exchanges most similar to the new
+question are pulled back in, so a user can refer to something from days ago
+without the prompt carrying days of raw history.
+
+Indexing happens on a background thread, off the request path.
+"""
+import hashlib
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import chromadb
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMemory:
+    """
+    Per-user vector index of past exchanges.
+
+    Args:
+        path: Directory of the memory's own Chroma database
+        embed: Function mapping a list of texts to a list of vectors
+        min_similarity: Cosine similarity an exchange needs to be recalled
+        max_chars: Longest slice of each message that is stored
+        max_batch: Most exchanges embedded together
+    """
+
+    def __init__(self, path, embed, min_similarity=0.35, max_chars=1000, max_batch=32):
+        self.embed = embed
+        self.min_similarity = min_similarity
+        self.max_chars = max_chars
+        self.max_batch = max_batch
+        self._client = chromadb.PersistentClient(path=path)
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.indexed = 0
+        self.recalls = 0
+        self.recalled = 0
+        self.failures = 0
+        threading.Thread(target=self._run, name="chat-memory-indexer", daemon=True).start()
+
+    @staticmethod
+    def _collection_name(user_id):
+        # Chroma names are limited in length and characters; user ids are not
+        return "chat_" + hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:24]
+
+    def _collection(self, user_id):
+        with self._lock:
+            collection = self._collections.get(user_id)
+            if collection is None:
+                collection = self._client.get_or_create_collection(
+                    self._collection_name(user_id), metadata={"hnsw:space": "cosine", "user_id": str(user_id)})
+                self._collections[user_id] = collection
+            return collection
+
+    def remember(self, user_id, user_text, assistant_text, timestamp=None):
+        """Queue an exchange for indexing; returns at once."""
+        if user_text and assistant_text:
+            self._queue.put((user_id, user_text[:self.max_chars], assistant_text[:self.max_chars],
+                             timestamp or time.time()))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._index(batch)
+            except Exception as e:
+                self.failures += len(batch)
+                logger.error("Indexing %d exchanges into chat memory failed: %s", len(batch), e)
+
+    def _index(self, batch):
+        documents = [f"User: {user_text}\nAssistant: {assistant_text}" for _, user_text, assistant_text, _ in batch]
+        vectors = self.embed(documents)
+        by_user = {}
+        for (user_id, user_text, _, timestamp), document, vector in zip(batch, documents, vectors):
+            entry = by_user.setdefault(user_id, ([], [], [], []))
+            entry[0].append(uuid.uuid4().hex)
+            entry[1].append([float(x) for x in vector])
+            entry[2].append(document)
+            entry[3].append({"user": user_text, "timestamp": timestamp})
+        for user_id, (ids, embeddings, documents, metadatas) in by_user.items():
+            self._collection(user_id).add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+            self.indexed += len(ids)
+
+    def recall(self, user_id, query_embedding, top_k=4, exclude=()):
+        """
+        Past exchanges most similar to the query, best first, as dicts with
+        document, similarity and timestamp. Exchanges whose user message is in
+        `exclude` (e.g. already in the prompt) are skipped.
+        """
+        self.recalls += 1
+        collection = self._collection(user_id)
+        count = collection.count()
+        if count == 0:
+            return []
+        exclude = {text[:self.max_chars] for text in exclude}
+        results = collection.query(query_embeddings=[query_embedding], n_results=min(count, top_k + len(exclude)),
+                                   include=["documents", "metadatas", "distances"])
+        recalled = []
+        for document, meta, distance in zip(results["documents"][0], results["metadatas"][0], results["distances"][0]):
+            # Cosine space: distance = 1 - similarity
+            similarity = 1.0 - distance
+            if similarity < self.min_similarity or meta.get("user") in exclude:
+                continue
+            recalled.append({"document": document, "similarity": round(similarity, 3),
+                             "timestamp": meta.get("timestamp")})
+            if len(recalled) >= top_k:
+                break
+        self.recalled += len(recalled)
+        return recalled
+
+    def stats(self):
+        return {
+            "users_loaded": len(self._collections),
+            "indexed": self.indexed,
+            "pending": self._queue.qsize(),
+            "recalls": self.recalls,
+            "recalled": self.recalled,
+            "failures": self.failures,
+            "min_similarity": self.min_similarity,
+        }
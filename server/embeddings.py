@@ -0,0 +1,151 @@
+"""
+Shared embedding service.
+
+One embedder serves /embed, RAG retrieval, the semantic response cache and
+ingestion. By default it is the ONNX all-MiniLM-L6-v2 model (the same
+vectors Chroma's implicit default produces, so existing collections stay
+valid). Set an embedding GGUF to use llama.cpp embedding mode instead; the
+knowledge base must then be re-ingested with it.
+
+Concurrent callers are micro-batched: a background thread collects the texts
+that arrive within a short window into one model call, and vectors for texts
+seen before come from a content-hash cache.
+"""
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def create_embedder(model_path=None):
+    """
+    Return a function mapping a list of texts to a list of vectors.
+
+    Uses llama.cpp embedding mode for model_path, else the ONNX MiniLM model.
+    """
+    if model_path:
+        from llama_cpp import Llama
+
+        llm = Llama(model_path=model_path, embedding=True, verbose=False)
+        return lambda texts: llm.embed(texts, normalize=True)
+    from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+    onnx = ONNXMiniLM_L6_V2()
+    return lambda texts: onnx(texts)
+
+
+class EmbeddingService:
+    """
+    Micro-batching, caching front end for an embedder.
+
+    Args:
+        embed_fn: Function mapping a list of texts to a list of vectors
+        max_batch: Most texts sent to the model in one call
+        max_wait_ms: How long to wait for more callers before running a partial batch
+        cache_size: Number of text vectors remembered
+    """
+
+    def __init__(self, embed_fn, max_batch=64, max_wait_ms=5, cache_size=50000):
+        self.embed_fn = embed_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.requests = 0
+        self.texts = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.embedded = 0
+        self.embed_seconds = 0.0
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def embed(self, texts):
+        """Embed a list of texts; blocks until every vector is available."""
+        texts = list(texts)
+        self.requests += 1
+        self.texts += len(texts)
+        vectors = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = self._key(text)
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    vectors[i] = vector
+                else:
+                    missing.setdefault(key, (text, []))[1].append(i)
+        futures = []
+        for key, (text, indices) in missing.items():
+            future = Future()
+            self._queue.put((key, text, future))
+            futures.append((future, indices))
+        for future, indices in futures:
+            vector = future.result()
+            for i in indices:
+                vectors[i] = vector
+        return [v.tolist() for v in vectors]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # The same text may arrive from several callers inside one window
+            unique = OrderedDict()
+            for key, text, future in batch:
+                unique.setdefault(key, (text, []))[1].append(future)
+            start = time.time()
+            try:
+                vectors = self.embed_fn([text for text, _ in unique.values()])
+            except Exception as e:
+                logger.error("Embedding batch of %d texts failed: %s", len(unique), e)
+                for _, futures in unique.values():
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+            self.embed_seconds += time.time() - start
+            self.batches += 1
+            self.embedded += len(unique)
+            with self._lock:
+                for (key, (_, futures)), vector in zip(unique.items(), vectors):
+                    vector = np.asarray(vector, dtype=np.float32)
+                    self._cache[key] = vector
+                    self._cache.move_to_end(key)
+                    for future in futures:
+                        future.set_result(vector)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "texts": self.texts,
+            "cache_entries": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_hit_rate": round(self.cache_hits / self.texts, 3) if self.texts else 0.0,
+            "batches": self.batches,
+            "avg_batch_size": round(self.embedded / self.batches, 2) if self.batches else 0.0,
+            "texts_per_second": round(self.embedded / self.embed_seconds, 1) if self.embed_seconds else 0.0,
+        }
@@ -0,0 +1,203 @@
+"""
+Pipelined knowledge base ingestion.
+
+Three stages run concurrently, connected by bounded queues so a fast stage
+cannot run ahead of a slow one by more than a few items:
+
+- readers (a few threads) extract the text of each file (PDF or plain text);
+- the chunker splits it into fixed-size chunks and drops the ones already
+  in the collection;
+- the writer embeds chunks in batches and adds each batch to the collection
+  with one call, i.e. one model call and one database transaction per batch
+  instead of per chunk.
+"""
+import logging
+import queue
+import threading
+import time
+
+from pypdf import PdfReader
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def read_text(path):
+    """Text of a PDF, text or code file."""
+    if path.lower().endswith(".pdf"):
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+
+def split_chunks(text, size=1000):
+    """(index, chunk) pairs of consecutive `size`-character slices, blank ones skipped."""
+    return [(i // size, text[i:i + size]) for i in range(0, len(text), size) if text[i:i + size].strip()]
+
+
+class IngestPipeline:
+    """
+    Reads, chunks, embeds and stores files into a Chroma collection.
+
+    Chunk ids are "<path>-<index>", so re-ingesting a file only adds the
+    chunks not stored yet.
+
+    Args:
+        collection: Chroma collection the chunks are added to
+        embed: Function mapping a list of texts to a list of vectors
+        batch_size: Chunks embedded and added per call
+        readers: Threads extracting file text
+        chunk_size: Characters per chunk
+        existing_ids: Ids already in the collection (read from it if None)
+        on_file: Called with (path, new chunks, metadata) once a file is chunked
+        on_error: Called with (path, exception) for a file that could not be ingested
+    """
+
+    def __init__(self, collection, embed, batch_size=64, readers=2, chunk_size=1000, existing_ids=None, on_file=None,
+                 on_error=None):
+        self.collection = collection
+        self.embed = embed
+        self.batch_size = batch_size
+        self.readers = readers
+        self.chunk_size = chunk_size
+        # Ids only: fetching the documents too would read the whole collection
+        self.existing_ids = set(existing_ids if existing_ids is not None else collection.get(include=[])["ids"])
+        self.on_file = on_file
+        self.on_error = on_error
+        self.files = 0
+        self.chunks = 0
+        self.skipped = 0
+        self.batches = 0
+        self.failed_chunks = 0
+        self.failed_files = set()
+        self.read_seconds = 0.0
+        self.embed_seconds = 0.0
+        self.write_seconds = 0.0
+        self.seconds = 0.0
+
+    def run(self, files):
+        """
+        Ingest files, given as (path, metadata) pairs; the metadata (e.g.
+        {"type": "code"}) is stored with each of the file's chunks. Returns stats().
+        """
+        start = time.time()
+        paths = queue.Queue()
+        for item in files:
+            paths.put(item)
+        texts = queue.Queue(maxsize=self.readers * 2)
+        chunks = queue.Queue(maxsize=self.batch_size * 4)
+        # Seconds each reader spent on files it read successfully, summed after join
+        read_times = [0.0] * self.readers
+        workers = [threading.Thread(target=self._read, args=(paths, texts, read_times, i), name=f"ingest-reader-{i}",
+                                    daemon=True)
+                   for i in range(self.readers)]
+        workers.append(threading.Thread(target=self._chunk, args=(texts, chunks), name="ingest-chunker", daemon=True))
+        for worker in workers:
+            worker.start()
+        self._write(chunks)
+        for worker in workers:
+            worker.join()
+        self.read_seconds = sum(read_times)
+        self.seconds = time.time() - start
+        return self.stats()
+
+    def _read(self, paths, texts, read_times, index):
+        try:
+            while True:
+                try:
+                    path, metadata = paths.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    text = read_text(path)
+                except Exception as e:
+                    self._failed(path, e)
+                    continue
+                read_times[index] += time.time() - start
+                texts.put((path, metadata, text))
+        finally:
+            texts.put(_DONE)
+
+    def _chunk(self, texts, chunks):
+        running = self.readers
+        try:
+            while running:
+                item = texts.get()
+                if item is _DONE:
+                    running -= 1
+                    continue
+                path, metadata, text = item
+                new = 0
+                for index, chunk in split_chunks(text, self.chunk_size):
+                    chunk_id = f"{path}-{index}"
+                    if chunk_id in self.existing_ids:
+                        self.skipped += 1
+                        continue
+                    self.existing_ids.add(chunk_id)
+                    chunks.put((chunk_id, chunk, dict(metadata, source=path, chunk=index)))
+                    new += 1
+                self.files += 1
+                if self.on_file is not None:
+                    self.on_file(path, new, metadata)
+        except Exception as e:
+            logger.error("Ingest chunker stopped: %s", e, exc_info=True)
+            # Let the readers finish instead of blocking on a full queue
+            while running:
+                if texts.get() is _DONE:
+                    running -= 1
+        finally:
+            # Always end the writer, or it would wait for chunks forever
+            chunks.put(_DONE)
+
+    def _write(self, chunks):
+        batch = []
+        while True:
+            item = chunks.get()
+            if item is not _DONE:
+                batch.append(item)
+            if batch and (item is _DONE or len(batch) >= self.batch_size):
+                self._write_batch(batch)
+                batch = []
+            if item is _DONE:
+                return
+
+    def _write_batch(self, batch):
+        ids, documents, metadatas = zip(*batch)
+        try:
+            start = time.time()
+            embeddings = self.embed(list(documents))
+            self.embed_seconds += time.time() - start
+            start = time.time()
+            self.collection.add(ids=list(ids), documents=list(documents), embeddings=embeddings,
+                                metadatas=list(metadatas))
+            self.write_seconds += time.time() - start
+        except Exception as e:
+            self.failed_chunks += len(batch)
+            for path in {meta["source"] for meta in metadatas}:
+                self._failed(path, e)
+            return
+        self.batches += 1
+        self.chunks += len(batch)
+
+    def _failed(self, path, error):
+        logger.error("Failed to ingest %s: %s", path, error)
+        self.failed_files.add(path)
+        if self.on_error is not None:
+            self.on_error(path, error)
+
+    def stats(self):
+        return {
+            "files": self.files,
+            "chunks": self.chunks,
+            "skipped": self.skipped,
+            "batches": self.batches,
+            "failed_chunks": self.failed_chunks,
+            "failed_files": sorted(self.failed_files),
+            "seconds": round(self.seconds, 3),
+            "chunks_per_second": round(self.chunks / self.seconds, 1) if self.seconds else 0.0,
+            "read_seconds": round(self.read_seconds, 3),
+            "embed_seconds": round(self.embed_seconds, 3),
+            "write_seconds": round(self.write_seconds, 3),
+        }
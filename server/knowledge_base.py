@@ -0,0 +1,159 @@
+"""
+Process-wide handle on the knowledge base's Chroma collection.
+
+Opening a PersistentClient reopens its SQLite database and reloads the HNSW
+segments (and, without an embedding service, Chroma's embedder), which costs
+far more than a query. The server opens the knowledge collection once and
+shares the handle between threads; each call then only pays for its query.
+
+The handle is reopened when the knowledge base version file changes under
+it, i.e. after `main.py ingest` or a backup restore swapped the directory
+from another process. Bumps made through add() are the server's own writes
+and keep the handle. A replaced handle is closed once the calls still using
+it have finished.
+"""
+import logging
+import threading
+import time
+
+import chromadb
+from chromadb.api.client import SharedSystemClient
+
+from server.semantic_cache import bump_kb_version, read_kb_version
+
+logger = logging.getLogger(__name__)
+
+
+class _Handle:
+    def __init__(self, client, collection, version):
+        self.client = client
+        self.collection = collection
+        self.version = version
+        self.users = 0
+        self.system = None
+
+
+def _detach_system(client):
+    """
+    Drop the client's System from chromadb's shared cache and return it (None if unknown).
+
+    Clients of one path share a cached System; removing it makes the next
+    client read the directory again instead of reusing stale segments. Only
+    this path's entry is removed where the cache layout is known (chromadb
+    0.4-1.x); otherwise the public clear_system_cache() is used, and the old
+    System is left for garbage collection rather than stopped.
+    """
+    cache = getattr(SharedSystemClient, "_identifier_to_system", None)
+    identifier = getattr(client, "_identifier", None)
+    if isinstance(cache, dict) and identifier is not None:
+        return cache.pop(identifier, None)
+    logger.warning("Unknown chromadb client cache layout; clearing the whole system cache")
+    SharedSystemClient.clear_system_cache()
+    return None
+
+
+class KnowledgeBase:
+    """
+    Shared, thread-safe access to the knowledge collection.
+
+    Args:
+        path: Chroma directory of the knowledge base
+        kb_version_path: Knowledge base version file, bumped by every write and restore
+        collection: Name of the knowledge collection
+    """
+
+    def __init__(self, path, kb_version_path, collection="knowledge"):
+        self.path = path
+        self.kb_version_path = kb_version_path
+        self.collection_name = collection
+        self._handle = None
+        self._cond = threading.Condition()
+        self.opens = 0
+        self.reloads = 0
+        self.queries = 0
+        self.open_seconds = 0.0
+
+    def open(self):
+        """Open the collection now (e.g. at startup) rather than on the first call."""
+        self._release(self._acquire())
+
+    def _open(self, version):
+        start = time.time()
+        client = chromadb.PersistentClient(path=self.path)
+        collection = client.get_or_create_collection(self.collection_name)
+        self.opens += 1
+        self.open_seconds += time.time() - start
+        return _Handle(client, collection, version)
+
+    def _acquire(self):
+        version = read_kb_version(self.kb_version_path)
+        with self._cond:
+            handle = self._handle
+            if handle is None or handle.version != version:
+                if handle is not None:
+                    logger.info("Knowledge base changed on disk (version %s), reopening %s", version, self.path)
+                    self.reloads += 1
+                    self._retire(handle)
+                handle = self._handle = self._open(version)
+            handle.users += 1
+            return handle
+
+    def _release(self, handle):
+        with self._cond:
+            handle.users -= 1
+            if handle.system is not None and handle.users == 0:
+                handle.system.stop()
+
+    def _retire(self, handle):
+        handle.system = _detach_system(handle.client)
+        if handle.system is not None and handle.users == 0:
+            handle.system.stop()
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=3):
+        handle = self._acquire()
+        try:
+            self.queries += 1
+            if query_embeddings is not None:
+                return handle.collection.query(query_embeddings=query_embeddings, n_results=n_results)
+            return handle.collection.query(query_texts=query_texts, n_results=n_results)
+        finally:
+            self._release(handle)
+
+    def get(self):
+        handle = self._acquire()
+        try:
+            return handle.collection.get()
+        finally:
+            self._release(handle)
+
+    def add(self, documents, embeddings=None, metadatas=None, ids=None):
+        """Add documents and bump the knowledge base version (cached answers may be stale)."""
+        handle = self._acquire()
+        try:
+            handle.collection.add(documents=documents, embeddings=embeddings, metadatas=metadatas, ids=ids)
+            with self._cond:
+                if read_kb_version(self.kb_version_path) == handle.version:
+                    # Our own write: the open handle already sees it
+                    handle.version = bump_kb_version(self.kb_version_path)
+                else:
+                    # Changed from outside meanwhile; the next call reopens
+                    bump_kb_version(self.kb_version_path)
+        finally:
+            self._release(handle)
+
+    def close(self):
+        with self._cond:
+            if self._handle is not None:
+                self._retire(self._handle)
+                self._handle = None
+
+    def stats(self):
+        handle = self._handle
+        return {
+            "open": handle is not None,
+            "version": handle.version if handle is not None else None,
+            "opens": self.opens,
+            "reloads": self.reloads,
+            "queries": self.queries,
+            "avg_open_seconds": round(self.open_seconds / self.opens, 3) if self.opens else 0.0,
+        }
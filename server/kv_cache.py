@@ -0,0 +1,100 @@
+"""
+KV-cache snapshots for the inference scheduler.
+
+The scheduler decodes many sequences on one llama.cpp context, so whole
+context save_state()/load_state() would clobber other users. Instead we use
+the per-sequence state API: a snapshot holds the tokens a sequence has
+evaluated plus the serialized KV cells of that sequence, and can be restored
+into any free sequence id.
+"""
+import ctypes
+import hashlib
+import threading
+from collections import OrderedDict
+
+import llama_cpp
+
+
+class SequenceSnapshot:
+    """Tokens evaluated by a sequence and the serialized KV state after them."""
+
+    __slots__ = ("tokens", "data")
+
+    def __init__(self, tokens, data):
+        self.tokens = list(tokens)
+        self.data = data
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def save_sequence(ctx, seq_id, tokens):
+    """Serialize the KV state of seq_id (which has evaluated exactly `tokens`)."""
+    size = llama_cpp.llama_state_seq_get_size(ctx, seq_id)
+    buf = (ctypes.c_uint8 * size)()
+    written = llama_cpp.llama_state_seq_get_data(ctx, buf, size, seq_id)
+    if not written:
+        raise RuntimeError(f"Failed to save state of sequence {seq_id}")
+    return SequenceSnapshot(tokens, bytes(buf)[:written])
+
+
+def restore_sequence(ctx, seq_id, snapshot):
+    """Load a snapshot into an empty sequence; returns False if llama.cpp rejects it."""
+    data = snapshot.data
+    buf = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+    return llama_cpp.llama_state_seq_set_data(ctx, buf, len(data), seq_id) != 0
+
+
+def prefix_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PrefixCache:
+    """
+    LRU of KV snapshots taken right after a static prompt prefix.
+
+    Keyed by a hash of the prefix text, so editing the system prompt simply
+    produces a new entry and the old one ages out.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def tokens_for(self, key, tokenize, text):
+        """Tokenize a prefix once per distinct text."""
+        tokens = self._tokens.get(key)
+        if tokens is None:
+            tokens = self._tokens[key] = list(tokenize(text))
+        return tokens
+
+    def get(self, key):
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return snapshot
+
+    def put(self, key, snapshot):
+        with self._lock:
+            self._entries[key] = snapshot
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._tokens.pop(old_key, None)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": sum(s.size for s in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,162 @@
+"""
+MongoDB schema migrations and indexes.
+
+Every hot lookup (a user's chat history in time order, the key/value
+documents in memory, context and user_info, upvoted feedback) is backed by an
+index so its cost does not grow with the collection. run_migrations() applies
+the pending one-off data migrations, recorded in the schema_migrations
+collection, then makes sure every index exists; both steps are idempotent,
+so it runs on each server start and from `main.py migrate`.
+
+explain_hot_queries() reports the plan MongoDB picks for each hot query, so a
+collection scan (COLLSCAN) creeping back in is easy to spot.
+"""
+import logging
+import time
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options)
+INDEXES = [
+    # Recent history for a user, either direction, and count_documents({"user_id": ...})
+    ("chat_history", [("user_id", ASCENDING), ("timestamp", ASCENDING)], {"name": "user_id_timestamp"}),
+    # Retention: finding the users with messages old enough to archive
+    ("chat_history", [("timestamp", ASCENDING)], {"name": "timestamp"}),
+    ("memory", [("key", ASCENDING)], {"name": "key_unique", "unique": True}),
+    ("context", [("key", ASCENDING)], {"name": "key_unique", "unique": True}),
+    ("user_info", [("key", ASCENDING)], {"name": "key_unique", "unique": True}),
+    ("summaries", [("key", ASCENDING)], {"name": "key_unique", "unique": True}),
+    # Answer cache warmup: upvoted answers, newest first
+    ("feedback", [("feedback", ASCENDING), ("timestamp", DESCENDING)], {"name": "feedback_timestamp"}),
+]
+
+
+def _dedupe(collection, field="key"):
+    """Keep only the newest document per value of field; returns the number removed."""
+    removed = 0
+    duplicates = collection.aggregate([
+        {"$sort": {"_id": -1}},
+        {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    for group in duplicates:
+        removed += collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    return removed
+
+
+def _dedupe_keys(db):
+    """
+    Keep only the newest document per key in the key/value collections.
+
+    Upserts without a unique index can race and leave duplicates, which would
+    stop the unique key indexes from building.
+    """
+    return {"duplicates_removed": sum(_dedupe(db[name]) for name in ("memory", "context", "user_info"))}
+
+
+# Applied in order, each exactly once
+MIGRATIONS = [
+    ("0001_dedupe_keys", _dedupe_keys),
+]
+
+
+def _create_unique_index(collection, keys, options):
+    """
+    Create a unique index, removing duplicates once if they block it; returns the name created.
+
+    If duplicates keep reappearing, a non-unique index under a separate
+    "<name>_fallback" name still serves the lookups. The unique name stays
+    missing, so the next run drops the fallback and tries again.
+    """
+    fallback = f"{options['name']}_fallback"
+    if fallback in collection.index_information():
+        # MongoDB allows only one index per key pattern
+        collection.drop_index(fallback)
+    try:
+        return collection.create_index(keys, **options)
+    except OperationFailure as e:
+        logger.warning("Unique index %s.%s failed (%s); removing duplicates and retrying", collection.name,
+                       options["name"], e)
+    removed = _dedupe(collection, keys[0][0])
+    try:
+        return collection.create_index(keys, **options)
+    except OperationFailure as e:
+        logger.warning("Unique index %s.%s still failed after removing %d duplicates (%s); creating %s instead",
+                       collection.name, options["name"], removed, e, fallback)
+    return collection.create_index(keys, **dict(options, unique=False, name=fallback))
+
+
+def ensure_indexes(db):
+    """Create any missing index; returns the names of the ones created."""
+    created = []
+    for collection, keys, options in INDEXES:
+        existing = db[collection].index_information()
+        if options["name"] in existing:
+            continue
+        if options.get("unique"):
+            name = _create_unique_index(db[collection], keys, options)
+        else:
+            name = db[collection].create_index(keys, **options)
+        created.append(f"{collection}.{name}")
+    return created
+
+
+def run_migrations(db):
+    """Apply pending migrations and ensure indexes; returns a report dict."""
+    start = time.time()
+    applied = {doc["_id"] for doc in db.schema_migrations.find({}, {"_id": 1})}
+    results = {}
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        results[name] = migrate(db)
+        db.schema_migrations.insert_one({"_id": name, "applied_at": time.time(), "result": results[name]})
+        logger.info("Applied migration %s: %s", name, results[name])
+    created = ensure_indexes(db)
+    if created:
+        logger.info("Created indexes: %s", ", ".join(created))
+    return {"migrations": results, "indexes_created": created, "seconds": round(time.time() - start, 3)}
+
+
+def _hot_queries(user_id):
+    return {
+        "chat_history.recent": lambda db: db.chat_history.find({"user_id": user_id}).sort("timestamp", -1).limit(10),
+        "chat_history.window": lambda db: db.chat_history.find({"user_id": user_id}).sort("timestamp", 1).limit(6),
+        "memory.key": lambda db: db.memory.find({"key": "x"}).limit(1),
+        "context.preferences": lambda db: db.context.find({"key": "preferences"}).limit(1),
+        "user_info.name": lambda db: db.user_info.find({"key": "name"}).limit(1),
+        "feedback.upvoted": lambda db: db.feedback.find({"feedback": "up"}).sort("timestamp", -1).limit(100),
+    }
+
+
+def _plan_stages(plan):
+    # Newer servers wrap the classic plan tree in "queryPlan"
+    plan = plan.get("queryPlan", plan)
+    stages, index = [], None
+    while plan:
+        stages.append(plan.get("stage"))
+        index = index or plan.get("indexName")
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages, index
+
+
+def explain_hot_queries(db, user_id="default"):
+    """Winning plan and execution stats of each hot query, keyed by query name."""
+    report = {}
+    for name, query in _hot_queries(user_id).items():
+        explain = query(db).explain()
+        stages, index = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        execution = explain.get("executionStats", {})
+        report[name] = {
+            "stages": stages,
+            "index": index,
+            "collection_scan": "COLLSCAN" in stages,
+            "returned": execution.get("nReturned"),
+            "keys_examined": execution.get("totalKeysExamined"),
+            "docs_examined": execution.get("totalDocsExamined"),
+            "ms": execution.get("executionTimeMillis"),
+        }
+    return report
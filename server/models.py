@@ -0,0 +1,208 @@
+"""
+Registry of the models the server can serve.
+
+Models are configured by name and loaded on first use. Loaded models are
+kept within a RAM budget: before a new model is loaded, the least recently
+used idle models are unloaded until it fits. A model that is still
+generating, or that get() handed to a request which has not released it
+yet, is never unloaded; the default model is loaded at startup.
+"""
+import gc
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ModelSpec:
+    """
+    How to load one named model.
+
+    Args:
+        name: Name requests use to pick the model
+        path: GGUF file
+        n_ctx: Context window per sequence
+        draft_path: Optional draft GGUF for speculative decoding
+        ram_mb: RAM the model needs once loaded (defaults to the file size)
+    """
+
+    def __init__(self, name, path, n_ctx=2048, draft_path=None, ram_mb=None):
+        self.name = name
+        self.path = path
+        self.n_ctx = n_ctx
+        self.draft_path = draft_path
+        self.ram_mb = ram_mb
+
+    @property
+    def size(self):
+        if self.ram_mb:
+            return int(self.ram_mb * 1024 * 1024)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self.draft_path and os.path.exists(self.draft_path):
+            size += os.path.getsize(self.draft_path)
+        return size
+
+
+def load_model_specs(path):
+    """
+    Read model specs from a JSON file of {"name": {"path": ..., ...}}.
+
+    Returns an empty dict if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    return {name: ModelSpec(name, **options) for name, options in config.items()}
+
+
+class LoadedModel:
+    """A loaded model: its generation backend plus a matching token counter."""
+
+    def __init__(self, spec, backend, token_counter):
+        self.spec = spec
+        self.backend = backend
+        self.token_counter = token_counter
+        self.size = spec.size
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.load_seconds = 0.0
+        # Requests holding the model between get() and release()
+        self.leases = 0
+
+    @property
+    def busy(self):
+        if self.leases:
+            return True
+        stats = self.backend.stats()
+        return bool(stats.get("active") or stats.get("pending") or stats.get("in_flight"))
+
+
+class ModelRegistry:
+    """
+    Lazily loads named models and unloads idle ones, least recently used first.
+
+    Args:
+        specs: {name: ModelSpec}
+        loader: Function ModelSpec -> LoadedModel
+        default: Name used when a request does not pick a model
+        max_bytes: RAM budget for all loaded models together (0 = unlimited)
+    """
+
+    def __init__(self, specs, loader, default, max_bytes=0):
+        if default not in specs:
+            raise ValueError(f"Default model '{default}' is not configured")
+        self.specs = dict(specs)
+        self.loader = loader
+        self.default = default
+        self.max_bytes = max_bytes
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.specs}
+        self.loads = 0
+        self.unloads = 0
+
+    def names(self):
+        return list(self.specs)
+
+    def loaded(self, name=None):
+        """Return a model only if it is already loaded (never triggers a load)."""
+        return self._loaded.get(name or self.default)
+
+    def get(self, name=None):
+        """
+        Return the named model, loading it first if needed; KeyError for unknown names.
+
+        The model is leased to the caller and not unloaded until release(model)
+        is called, which must happen once its generation has finished.
+        """
+        name = name or self.default
+        if name not in self.specs:
+            raise KeyError(f"Unknown model '{name}'. Available: {', '.join(self.specs)}")
+        while True:
+            model = self._loaded.get(name)
+            if model is None:
+                with self._load_locks[name]:
+                    model = self._loaded.get(name)
+                    if model is None:
+                        model = self._load(self.specs[name])
+            with self._lock:
+                # It may have been unloaded since the lookup; then load it again
+                if self._loaded.get(name) is model:
+                    model.leases += 1
+                    model.last_used = time.time()
+                    return model
+
+    def release(self, model):
+        """Give back a model returned by get()."""
+        with self._lock:
+            model.leases -= 1
+
+    def _load(self, spec):
+        if not os.path.exists(spec.path):
+            raise RuntimeError(f"Model file not found at {spec.path}")
+        self._make_room(spec.size)
+        start = time.time()
+        model = self.loader(spec)
+        model.load_seconds = time.time() - start
+        with self._lock:
+            self._loaded[spec.name] = model
+            self.loads += 1
+        logger.info("Loaded model %s in %.1fs", spec.name, model.load_seconds)
+        return model
+
+    def _make_room(self, needed):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            used = sum(m.size for m in self._loaded.values())
+            candidates = sorted(self._loaded.values(), key=lambda m: m.last_used)
+        for model in candidates:
+            if used + needed <= self.max_bytes:
+                return
+            if self.unload(model.spec.name, idle_only=True):
+                used -= model.size
+        if used + needed > self.max_bytes:
+            logger.warning("Loading a %d MB model exceeds the %d MB model budget; all other models are busy",
+                           needed >> 20, self.max_bytes >> 20)
+
+    def unload(self, name, idle_only=False):
+        """Unload a model; with idle_only, only if it is neither leased nor generating."""
+        with self._lock:
+            model = self._loaded.get(name)
+            if model is None or (idle_only and model.busy):
+                return False
+            del self._loaded[name]
+            self.unloads += 1
+        model.backend.close()
+        del model
+        gc.collect()
+        logger.info("Unloaded model %s", name)
+        return True
+
+    def stats(self):
+        loaded = dict(self._loaded)
+        return {
+            "default": self.default,
+            "budget_mb": self.max_bytes >> 20,
+            "used_mb": sum(m.size for m in loaded.values()) >> 20,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "models": {
+                name: {
+                    "path": spec.path,
+                    "loaded": name in loaded,
+                    "size_mb": spec.size >> 20,
+                    "last_used": loaded[name].last_used if name in loaded else None,
+                    "load_seconds": round(loaded[name].load_seconds, 2) if name in loaded else None,
+                }
+                for name, spec in self.specs.items()
+            },
+        }
+
+    def close(self):
+        for name in list(self._loaded):
+            self.unload(name)
@@ -0,0 +1,230 @@
+"""
+Retention, compaction and archival of stored data.
+
+The hot store only keeps what requests read: recent chat history, plus
+feedback and corrections for as long as they are configured to live.
+Periodically:
+
+- chat messages older than their collection's retention period are moved,
+  per user, into gzip-compressed JSON-lines archive segments on disk and
+  deleted from the hot store; the archive can still be read on demand;
+- documents of other collections past their retention period are deleted;
+- archive segments past the archive retention period are deleted.
+
+Timestamps are epoch seconds, so the periodic, index-backed delete takes the
+place of a TTL index on both storage backends.
+"""
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+
+
+def _gzip_raw_size(path):
+    # The gzip trailer stores the uncompressed size (mod 2**32) in its last four bytes
+    with open(path, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", f.read(4))[0]
+
+
+class ChatArchive:
+    """
+    Per-user compressed segments of archived chat messages.
+
+    Each segment is <archive>/<user hash>/<first ts>-<last ts>.jsonl.gz with
+    one {"timestamp", "message"} object per line, oldest first.
+
+    Args:
+        path: Archive root directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.path, hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:24])
+
+    def write_segment(self, user_id, messages):
+        """Archive messages ({"timestamp", "message"}, oldest first); returns (path, raw bytes, stored bytes)."""
+        user_dir = self._user_dir(user_id)
+        os.makedirs(user_dir, exist_ok=True)
+        name = f"{messages[0]['timestamp']:.6f}-{messages[-1]['timestamp']:.6f}.jsonl.gz"
+        path = os.path.join(user_dir, name)
+        raw = "".join(json.dumps({"timestamp": m["timestamp"], "message": m["message"]}, default=str) + "\n"
+                      for m in messages).encode("utf-8")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=9, mtime=0) as gz:
+                gz.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # Keeps the user id next to its hashed directory for reporting
+        user_file = os.path.join(user_dir, "user_id")
+        if not os.path.exists(user_file):
+            with open(user_file, "w", encoding="utf-8") as f:
+                f.write(str(user_id))
+        return path, len(raw), os.path.getsize(path)
+
+    def segments(self, user_id):
+        """The user's segment paths, oldest first."""
+        user_dir = self._user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return []
+        return [os.path.join(user_dir, n) for n in sorted(os.listdir(user_dir)) if n.endswith(".jsonl.gz")]
+
+    def read(self, user_id, limit=None, before=None):
+        """
+        Archived messages of a user as {"timestamp", "message"}, oldest first;
+        with limit, only the newest `limit` (older than `before` if given).
+        Segments are read newest first, so recent pages touch few files.
+        """
+        messages = []
+        for path in reversed(self.segments(user_id)):
+            if before is not None and float(os.path.basename(path).split("-")[0]) >= before:
+                continue
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                segment = [json.loads(line) for line in f if line.strip()]
+            if before is not None:
+                segment = [m for m in segment if m["timestamp"] < before]
+            messages = segment + messages
+            if limit and len(messages) >= limit:
+                return messages[-limit:]
+        return messages
+
+    def expire(self, before):
+        """Delete segments whose newest message is older than `before`; returns how many were removed."""
+        removed = 0
+        for user_dir in self._user_dirs():
+            for name in os.listdir(user_dir):
+                if name.endswith(".jsonl.gz") and float(name[:-len(".jsonl.gz")].split("-")[1]) < before:
+                    os.remove(os.path.join(user_dir, name))
+                    removed += 1
+        return removed
+
+    def _user_dirs(self):
+        return [os.path.join(self.path, d) for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
+
+    def stats(self):
+        users = segments = raw_bytes = stored_bytes = 0
+        for user_dir in self._user_dirs():
+            names = [n for n in os.listdir(user_dir) if n.endswith(".jsonl.gz")]
+            users += bool(names)
+            for name in names:
+                path = os.path.join(user_dir, name)
+                segments += 1
+                stored_bytes += os.path.getsize(path)
+                raw_bytes += _gzip_raw_size(path)
+        return {
+            "users": users,
+            "segments": segments,
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "compression_ratio": round(raw_bytes / stored_bytes, 2) if stored_bytes else 0.0,
+        }
+
+
+class RetentionManager:
+    """
+    Applies the retention policy now (run_once) or periodically (start).
+
+    Args:
+        storage: Storage backend holding the hot data
+        archive: ChatArchive receiving chat_history past its retention period
+        retention_days: {collection: days}; chat_history is archived, other collections deleted
+            (0 or missing = kept forever)
+        archive_days: Days archive segments are kept (0 = forever)
+        segment_size: Most messages per archive segment
+        on_archived: Called with (user_id, messages archived) after each segment
+        interval: Seconds between periodic runs
+        archive_lock: Lock held from deleting a segment's messages until on_archived returns
+    """
+
+    def __init__(self, storage, archive, retention_days, archive_days=0, segment_size=1000, on_archived=None,
+                 interval=3600, archive_lock=None):
+        self.storage = storage
+        self.archive = archive
+        self.retention_days = dict(retention_days)
+        self.archive_days = archive_days
+        self.segment_size = segment_size
+        self.on_archived = on_archived
+        self.interval = interval
+        self.archive_lock = archive_lock if archive_lock is not None else contextlib.nullcontext()
+        self.runs = 0
+        self.last_run = None
+        self.last_report = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._loop, name="retention", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.storage.available:
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Retention run failed: %s", e, exc_info=True)
+
+    def run_once(self, now=None):
+        """Archive, expire and delete what the policy says; returns a report dict."""
+        with self._lock:
+            now = now or time.time()
+            start = time.time()
+            report = {"archived_messages": 0, "segments_written": 0, "raw_bytes": 0, "stored_bytes": 0,
+                      "deleted": {}, "segments_expired": 0}
+            chat_days = self.retention_days.get("chat_history", 0)
+            if chat_days:
+                self._archive_chat_history(now - chat_days * DAY, report)
+            for collection, days in self.retention_days.items():
+                if collection != "chat_history" and days:
+                    report["deleted"][collection] = self.storage.delete_documents(collection, now - days * DAY)
+            if self.archive_days:
+                report["segments_expired"] = self.archive.expire(now - self.archive_days * DAY)
+            report["seconds"] = round(time.time() - start, 3)
+            self.runs += 1
+            self.last_run = now
+            self.last_report = report
+            if report["archived_messages"] or any(report["deleted"].values()) or report["segments_expired"]:
+                logger.info("Retention: %s", report)
+            return report
+
+    def _archive_chat_history(self, cutoff, report):
+        for user_id in self.storage.message_users(cutoff):
+            while True:
+                docs = self.storage.old_messages(user_id, cutoff, self.segment_size)
+                if not docs:
+                    break
+                # Written and synced before the hot copies are deleted, so a crash never loses messages
+                _, raw_bytes, stored_bytes = self.archive.write_segment(user_id, docs)
+                with self.archive_lock:
+                    deleted = self.storage.delete_messages([doc["_id"] for doc in docs])
+                    if self.on_archived is not None:
+                        self.on_archived(user_id, deleted)
+                report["archived_messages"] += deleted
+                report["segments_written"] += 1
+                report["raw_bytes"] += raw_bytes
+                report["stored_bytes"] += stored_bytes
+                if len(docs) < self.segment_size:
+                    break
+
+    def stats(self):
+        return {
+            "retention_days": self.retention_days,
+            "archive_days": self.archive_days,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_report": self.last_report,
+        }
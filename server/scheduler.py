@@ -0,0 +1,714 @@
+"""
+Continuous-batching inference scheduler.
+
+All chat generation goes through one InferenceScheduler. It owns a
+multi-sequence llama.cpp context built on the already loaded model weights,
+gives every request its own sequence id ("slot"), and on each step packs one
+decode token per active slot plus prompt chunks of newly admitted requests
+into a single llama_batch. Tokens are streamed back per request, so several
+users share the model instead of queueing behind each other.
+
+Requests may name a static prompt prefix (the fixed part of the system
+prompt). The KV state after that prefix is snapshotted once and restored
+into each new sequence, so only the dynamic suffix is evaluated. Requests
+tagged with a session id additionally resume from the KV state their
+session had after its previous turn.
+
+With a draft model configured, each step first lets the draft propose a few
+tokens per decoding sequence and the main model verifies them all in the
+same batch (speculative decoding).
+
+Requests waiting for a free slot sit in a bounded AdmissionQueue, ordered
+by priority; submit() raises QueueFull when it has no room.
+"""
+import asyncio
+import codecs
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import llama_cpp
+import numpy as np
+
+from server.admission import PRIORITY_INTERACTIVE, AdmissionQueue
+from server.kv_cache import PrefixCache, prefix_key, restore_sequence, save_sequence
+from server.session_cache import common_prefix_length
+
+logger = logging.getLogger(__name__)
+
+
+def _llama_fn(*names):
+    """Return the first llama_cpp binding that exists (names moved between releases)."""
+    for name in names:
+        fn = getattr(llama_cpp, name, None)
+        if fn is not None:
+            return fn
+    raise AttributeError(f"llama_cpp provides none of: {', '.join(names)}")
+
+
+_new_context = _llama_fn("llama_init_from_model", "llama_new_context_with_model")
+_kv_seq_rm = _llama_fn("llama_kv_self_seq_rm", "llama_kv_cache_seq_rm")
+
+# Sentinel pushed onto a request's output queue once generation has ended
+_DONE = object()
+
+# Context size to create the scheduler's Llama objects with. The scheduler
+# decodes in contexts of its own and only uses their weights and vocabulary,
+# so a full-size context there would be KV cache nobody touches
+HANDLE_N_CTX = 64
+
+
+def render_chat_prompt(messages):
+    """
+    Render chat messages with the Mistral instruct template.
+
+    Mistral has no system role, so system messages are folded into the first
+    user turn. Consecutive turns of the same role are merged.
+    """
+    system = []
+    turns = []
+    for msg in messages:
+        role = msg.get("role", "user")
+        content = (msg.get("content") or "").strip()
+        if not content:
+            continue
+        if role == "system":
+            system.append(content)
+            continue
+        if role != "assistant":
+            role = "user"
+        if turns and turns[-1][0] == role:
+            turns[-1][1].append(content)
+        else:
+            turns.append((role, [content]))
+    if system:
+        if turns and turns[0][0] == "user":
+            turns[0][1][:0] = system
+        else:
+            turns.insert(0, ("user", system))
+    prompt = "<s>"
+    for role, parts in turns:
+        text = "\n\n".join(parts)
+        if role == "user":
+            prompt += f"[INST] {text} [/INST]"
+        else:
+            # Leading space matches how the model emits its first answer token,
+            # so a stored answer re-tokenizes to the tokens that were generated.
+            prompt += f" {text}</s>"
+    return prompt
+
+
+def sample_token(logits, rng, temperature=0.2, top_k=40, top_p=0.95):
+    """Pick the next token from a logits row (same defaults as create_chat_completion)."""
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    if 0 < top_k < logits.size:
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+    else:
+        candidates = np.arange(logits.size)
+    scores = logits[candidates].astype(np.float64) / temperature
+    order = np.argsort(-scores)
+    candidates = candidates[order]
+    scores = scores[order]
+    probs = np.exp(scores - scores[0])
+    probs /= probs.sum()
+    if top_p < 1.0:
+        keep = int(np.searchsorted(np.cumsum(probs), top_p)) + 1
+        candidates = candidates[:keep]
+        probs = probs[:keep] / probs[:keep].sum()
+    return int(rng.choice(candidates, p=probs))
+
+
+def split_at_stop(text, stop):
+    """
+    Split streamed text against stop strings.
+
+    Returns (emit, held, hit): text safe to emit now, a tail that could still
+    turn into a stop string, and whether a stop string was found.
+    """
+    hits = [text.find(s) for s in stop if s and s in text]
+    if hits:
+        return text[:min(hits)], "", True
+    held = 0
+    for s in stop:
+        for k in range(min(len(s) - 1, len(text)), 0, -1):
+            if text.endswith(s[:k]):
+                held = max(held, k)
+                break
+    return text[:len(text) - held], text[len(text) - held:], False
+
+
+class GenerationRequest:
+    """A single generation submitted to the scheduler; iterate it to stream text."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, prompt_tokens, max_tokens=256, stop=None, temperature=0.2, top_p=0.95, top_k=40):
+        self.id = next(self._ids)
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.stop = list(stop or [])
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.prefix_key = None
+        self.n_prefix = 0
+        self.session_id = None
+        self.n_reused = 0
+        self.priority = PRIORITY_INTERACTIVE
+        self.deadline = None
+        self.text = ""
+        self.n_generated = 0
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+        self.submitted_at = time.time()
+        self.first_token_at = None
+        self.finished_at = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._async_queue = None
+        self._on_cancel = None
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def cancel(self):
+        """Ask the scheduler to stop this generation and free its slot."""
+        if self.cancelled or self.done:
+            return
+        self.cancelled = True
+        if self._on_cancel is not None:
+            self._on_cancel()
+
+    def _emit(self, item):
+        with self._lock:
+            loop, async_queue = self._loop, self._async_queue
+            if loop is None:
+                self._queue.put(item)
+                return
+        try:
+            loop.call_soon_threadsafe(async_queue.put_nowait, item)
+        except RuntimeError:
+            # The consumer's event loop is gone; nobody is listening anymore
+            self.cancel()
+
+    def _push(self, text):
+        self.text += text
+        self._emit(text)
+
+    def _finish(self, reason, error=None):
+        if self.done:
+            return
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        self._emit(_DONE)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    async def stream(self):
+        """Async counterpart of iterating the request."""
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._async_queue = asyncio.Queue()
+            while True:
+                try:
+                    self._async_queue.put_nowait(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+        while True:
+            item = await self._async_queue.get()
+            if item is _DONE:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        """Block until generation finishes and return the full text."""
+        for _ in self:
+            pass
+        return self.text
+
+    async def aresult(self):
+        async for _ in self.stream():
+            pass
+        return self.text
+
+
+class _Slot:
+    """Per-sequence decode state for an admitted request."""
+
+    def __init__(self, seq_id, request):
+        self.seq_id = seq_id
+        self.request = request
+        self.admitted_at = time.time()
+        self.pending = list(request.prompt_tokens)
+        self.n_past = 0
+        self.n_generated = 0
+        self.generated = []
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.tail = ""
+        # Position at which to snapshot the KV state for the prefix cache
+        self.capture_at = None
+        # Tokens of this sequence evaluated by the draft model, and where its proposals start
+        self.draft_n_past = 0
+        self.draft_base = 0
+
+
+class InferenceScheduler:
+    """
+    Interleaves decode steps of concurrent requests on one model.
+
+    Args:
+        llm: Loaded llama_cpp.Llama whose weights and tokenizer are shared
+        n_slots: Maximum number of sequences decoded together
+        n_ctx: Context window available to each sequence
+        n_batch: Maximum tokens evaluated per llama_decode call
+        prefix_cache_size: Number of static-prefix KV snapshots kept in RAM
+        session_cache: Optional SessionCache for per-session KV reuse
+        draft_llm: Optional small Llama sharing llm's vocabulary, used for speculative decoding
+        draft_k: Tokens the draft model proposes per step
+        max_queue: Maximum number of requests waiting for a slot
+    """
+
+    def __init__(self, llm, n_slots=4, n_ctx=2048, n_batch=512, prefix_cache_size=8, session_cache=None,
+                 draft_llm=None, draft_k=4, max_queue=16, seed=None):
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self._n_vocab = llm.n_vocab()
+        self._eos = llm.token_eos()
+        self._rng = np.random.default_rng(seed)
+        self.prefix_cache = PrefixCache(prefix_cache_size)
+        self.session_cache = session_cache
+
+        self._ctx = self._create_context(llm)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self.draft_llm = None
+        self.draft_k = draft_k
+        self._draft_ctx = None
+        if draft_llm is not None:
+            if draft_llm.n_vocab() != self._n_vocab:
+                logger.warning("Draft model vocabulary (%s) differs from the main model (%s); speculative decoding disabled",
+                               draft_llm.n_vocab(), self._n_vocab)
+            else:
+                self.draft_llm = draft_llm
+                self._draft_ctx = self._create_context(draft_llm)
+                self._draft_batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self._pending = AdmissionQueue(max_queue, n_slots)
+        self._free = list(range(n_slots - 1, -1, -1))
+        self._active = []
+        self._tokens_generated = 0
+        self._draft_proposed = 0
+        self._draft_accepted = 0
+        self._decode_time = 0.0
+        self._requests_completed = 0
+        self._requests_cancelled = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+        self._thread.start()
+
+    def _create_context(self, model_llm):
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx * self.n_slots
+        params.n_batch = self.n_batch
+        params.n_ubatch = self.n_batch
+        params.n_seq_max = self.n_slots
+        params.n_threads = getattr(model_llm, "n_threads", params.n_threads)
+        params.n_threads_batch = getattr(model_llm, "n_threads_batch", params.n_threads_batch)
+        ctx = _new_context(model_llm.model, params)
+        if not ctx:
+            raise RuntimeError("Failed to create a multi-sequence llama context")
+        return ctx
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def submit(self, messages=None, prompt_tokens=None, max_tokens=256, stop=None, static_prefix=None,
+               session_id=None, priority=PRIORITY_INTERACTIVE, deadline=None, **sampling):
+        """
+        Queue a chat (or pre-tokenized prompt) for generation and return its request.
+
+        static_prefix is the leading, request-independent part of the system
+        message; when given, its KV state is served from the prefix cache.
+        session_id (usually the user id) enables the session KV cache.
+        priority orders the wait for a slot, and a request still waiting at
+        deadline (absolute time) finishes as "expired". Raises QueueFull when
+        the admission queue has no room.
+        """
+        prompt = None
+        if prompt_tokens is None:
+            prompt = render_chat_prompt(messages)
+            prompt_tokens = self.tokenize(prompt)
+        request = GenerationRequest(prompt_tokens, max_tokens=max_tokens, stop=stop, **sampling)
+        request.session_id = session_id
+        request.priority = priority
+        request.deadline = deadline
+        if static_prefix and prompt is not None:
+            self._attach_prefix(request, prompt, static_prefix)
+        if not self._running:
+            request._finish("error", RuntimeError("Scheduler is shut down"))
+            return request
+        request._on_cancel = lambda: self._dequeue(request)
+        self._pending.put(request)
+        return request
+
+    def _dequeue(self, request):
+        # A request cancelled while queued gives its place back immediately;
+        # an admitted one is finished by the decode thread on its next step.
+        if self._pending.discard(request):
+            request._finish("cancelled")
+
+    def _attach_prefix(self, request, prompt, static_prefix):
+        head = "<s>[INST] " + static_prefix.strip()
+        if not prompt.startswith(head):
+            return
+        key = prefix_key(head)
+        prefix_tokens = self.prefix_cache.tokens_for(key, self.tokenize, head)
+        # The prefix must tokenize identically on its own and inside the prompt,
+        # and leave at least one token to evaluate for the first logits.
+        n = len(prefix_tokens)
+        if n < len(request.prompt_tokens) and request.prompt_tokens[:n] == prefix_tokens:
+            request.prefix_key = key
+            request.n_prefix = n
+
+    def stats(self):
+        return {
+            "slots": self.n_slots,
+            "active": len(self._active),
+            "pending": len(self._pending),
+            "requests_completed": self._requests_completed,
+            "requests_cancelled": self._requests_cancelled,
+            "tokens_generated": self._tokens_generated,
+            "tokens_per_second": round(self._tokens_generated / self._decode_time, 2) if self._decode_time else 0.0,
+            "speculative": {
+                "enabled": self._draft_ctx is not None,
+                "proposed": self._draft_proposed,
+                "accepted": self._draft_accepted,
+                "acceptance_rate": round(self._draft_accepted / self._draft_proposed, 3) if self._draft_proposed else 0.0,
+            },
+            "queue": self._pending.stats(),
+            "prefix_cache": self.prefix_cache.stats(),
+            "session_cache": self.session_cache.stats() if self.session_cache is not None else None,
+        }
+
+    def close(self):
+        self._running = False
+        self._pending.close()
+        self._thread.join(timeout=10)
+        for request in self._pending.drain():
+            request._finish("error", RuntimeError("Scheduler is shut down"))
+        if self._thread.is_alive():
+            # Freeing the context under a running llama_decode would be a use-after-free; leak it instead
+            logger.error("Decode thread did not stop within 10s; leaving its llama.cpp context allocated")
+            return
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+        if self._draft_ctx is not None:
+            llama_cpp.llama_batch_free(self._draft_batch)
+            llama_cpp.llama_free(self._draft_ctx)
+
+    # --- decode thread ---
+
+    def _run(self):
+        while self._running:
+            self._admit()
+            if not self._active:
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                logger.error("Scheduler step failed: %s", e, exc_info=True)
+                for slot in list(self._active):
+                    self._finish(slot, "error", e)
+        for slot in list(self._active):
+            self._finish(slot, "error", RuntimeError("Scheduler is shut down"))
+
+    def _admit(self):
+        while self._free:
+            # Sleep on the queue only when there is nothing to decode
+            request = self._pending.get(block=not self._active)
+            if request is None:
+                return
+            if request.cancelled:
+                request._finish("cancelled")
+                continue
+            if not request.prompt_tokens or len(request.prompt_tokens) >= self.n_ctx:
+                request._finish("error", ValueError(
+                    f"Prompt of {len(request.prompt_tokens)} tokens does not fit the {self.n_ctx}-token context"))
+                continue
+            slot = _Slot(self._free.pop(), request)
+            if not self._restore_session(slot) and request.prefix_key:
+                self._restore_prefix(slot)
+            request.n_reused = slot.n_past
+            self._active.append(slot)
+
+    def _restore_session(self, slot):
+        request = slot.request
+        if self.session_cache is None or request.session_id is None:
+            return False
+        snapshot = self.session_cache.get(request.session_id)
+        if snapshot is None:
+            return False
+        # Keep at least one prompt token to evaluate so we get fresh logits
+        n_keep = min(common_prefix_length(snapshot.tokens, request.prompt_tokens), len(request.prompt_tokens) - 1)
+        if n_keep <= request.n_prefix:
+            return False
+        if not restore_sequence(self._ctx, slot.seq_id, snapshot):
+            _kv_seq_rm(self._ctx, slot.seq_id, -1, -1)
+            return False
+        # Drop whatever the previous turn evaluated past the shared prefix
+        _kv_seq_rm(self._ctx, slot.seq_id, n_keep, -1)
+        slot.n_past = n_keep
+        slot.pending = request.prompt_tokens[n_keep:]
+        return True
+
+    def _restore_prefix(self, slot):
+        request = slot.request
+        snapshot = self.prefix_cache.get(request.prefix_key)
+        if snapshot is None:
+            slot.capture_at = request.n_prefix
+        elif restore_sequence(self._ctx, slot.seq_id, snapshot):
+            slot.n_past = request.n_prefix
+            slot.pending = request.prompt_tokens[request.n_prefix:]
+        else:
+            _kv_seq_rm(self._ctx, slot.seq_id, -1, -1)
+
+    def _logits(self, ctx, index):
+        return np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, index), shape=(self._n_vocab,))
+
+    def _step(self):
+        for slot in [s for s in self._active if s.request.cancelled]:
+            self._finish(slot, "cancelled")
+        if not self._active:
+            return
+
+        start = time.time()
+        proposals = self._draft() if self._draft_ctx is not None else {}
+
+        batch = self._batch
+        n = 0
+        wants_logits = []
+        verifies = []
+        # Slots that are already decoding go first so every stream keeps moving;
+        # prompt prefill fills whatever is left of the batch.
+        for slot in sorted(self._active, key=lambda s: s.n_generated == 0):
+            budget = self.n_batch - n
+            proposal = proposals.get(slot)
+            if proposal and 1 + len(proposal) > budget:
+                proposal = proposals[slot] = []
+            if proposal:
+                # Last sampled token plus the draft, with logits on every position
+                first = n
+                for i, token in enumerate(slot.pending + proposal):
+                    self._add(batch, n, token, slot.n_past + i, slot.seq_id, True)
+                    n += 1
+                verifies.append((slot, first, proposal, slot.n_past))
+                slot.pending = []
+                continue
+            if slot.capture_at is not None:
+                # Stop this chunk exactly at the prefix boundary so it can be snapshotted
+                budget = min(budget, slot.capture_at - slot.n_past)
+            take = slot.pending[:budget]
+            if not take:
+                continue
+            for i, token in enumerate(take):
+                self._add(batch, n, token, slot.n_past + i, slot.seq_id, False)
+                n += 1
+            slot.n_past += len(take)
+            del slot.pending[:len(take)]
+            if not slot.pending:
+                batch.logits[n - 1] = True
+                wants_logits.append((slot, n - 1))
+            if n >= self.n_batch:
+                break
+        batch.n_tokens = n
+
+        rc = llama_cpp.llama_decode(self._ctx, batch)
+        if rc != 0:
+            raise RuntimeError(f"llama_decode returned {rc}")
+        for slot in self._active:
+            if slot.capture_at is not None and slot.n_past == slot.capture_at:
+                request = slot.request
+                snapshot = save_sequence(self._ctx, slot.seq_id, request.prompt_tokens[:request.n_prefix])
+                self.prefix_cache.put(request.prefix_key, snapshot)
+                slot.capture_at = None
+        for slot, index in wants_logits:
+            request = slot.request
+            token = sample_token(self._logits(self._ctx, index), self._rng, request.temperature, request.top_k, request.top_p)
+            self._accept(slot, token)
+        for slot, first, proposal, base in verifies:
+            self._verify(slot, first, proposal, base)
+        for slot, proposal in proposals.items():
+            if not proposal and slot in self._active:
+                self._sync_draft(slot, 0, 0)
+        self._decode_time += time.time() - start
+
+    @staticmethod
+    def _add(batch, index, token, pos, seq_id, logits):
+        batch.token[index] = token
+        batch.pos[index] = pos
+        batch.n_seq_id[index] = 1
+        batch.seq_id[index][0] = seq_id
+        batch.logits[index] = logits
+
+    # --- speculative decoding ---
+
+    def _draft(self):
+        """
+        Let the draft model propose tokens for every decoding slot.
+
+        The draft context first catches up on tokens the main model has
+        committed since the last step (the whole prompt on a slot's first
+        step), then greedily proposes up to draft_k tokens per slot, batched
+        across slots. Returns {slot: [proposed tokens]}.
+        """
+        batch = self._draft_batch
+        n = 0
+        rows = []
+        for slot in self._active:
+            remaining = slot.request.max_tokens - slot.n_generated
+            if slot.n_generated == 0 or len(slot.pending) != 1 or remaining < 2:
+                continue
+            if slot.n_past + self.draft_k + 1 >= self.n_ctx:
+                continue
+            tokens = slot.request.prompt_tokens + slot.generated
+            feed = tokens[slot.draft_n_past:][:self.n_batch - n]
+            if not feed:
+                continue
+            for i, token in enumerate(feed):
+                self._add(batch, n, token, slot.draft_n_past + i, slot.seq_id, False)
+                n += 1
+            slot.draft_n_past += len(feed)
+            if slot.draft_n_past == len(tokens):
+                batch.logits[n - 1] = True
+                rows.append((slot, n - 1, min(self.draft_k, remaining - 1)))
+            if n >= self.n_batch:
+                break
+        if not n:
+            return {}
+        batch.n_tokens = n
+        if llama_cpp.llama_decode(self._draft_ctx, batch) != 0:
+            raise RuntimeError("Draft model llama_decode failed")
+
+        proposals = {}
+        for slot, index, _ in rows:
+            proposals[slot] = [int(np.argmax(self._logits(self._draft_ctx, index)))]
+            slot.draft_base = slot.draft_n_past
+        limits = {slot: k for slot, _, k in rows}
+        for step in range(1, self.draft_k):
+            growing = [s for s, p in proposals.items() if len(p) < limits[s] and p[-1] != self._eos]
+            if not growing:
+                break
+            for i, slot in enumerate(growing):
+                self._add(batch, i, proposals[slot][-1], slot.draft_base + step - 1, slot.seq_id, True)
+            batch.n_tokens = len(growing)
+            if llama_cpp.llama_decode(self._draft_ctx, batch) != 0:
+                raise RuntimeError("Draft model llama_decode failed")
+            for i, slot in enumerate(growing):
+                proposals[slot].append(int(np.argmax(self._logits(self._draft_ctx, i))))
+        return proposals
+
+    def _verify(self, slot, first, proposal, base):
+        """
+        Accept the longest prefix of the draft that the main model agrees with.
+
+        Each position is sampled from the main model exactly as in normal
+        decoding; a draft token is kept only if it equals that sample, so the
+        output distribution is unchanged (and identical under greedy decoding).
+        """
+        request = slot.request
+        accepted = 0
+        for j in range(len(proposal) + 1):
+            token = sample_token(self._logits(self._ctx, first + j), self._rng,
+                                 request.temperature, request.top_k, request.top_p)
+            slot.n_past = base + j + 1
+            if not self._accept(slot, token):
+                break
+            if j < len(proposal) and token == proposal[j]:
+                accepted += 1
+                continue
+            break
+        self._draft_proposed += len(proposal)
+        self._draft_accepted += accepted
+        if slot not in self._active:
+            return
+        # Forget KV of rejected draft tokens in both contexts
+        _kv_seq_rm(self._ctx, slot.seq_id, slot.n_past, -1)
+        self._sync_draft(slot, accepted, len(proposal))
+
+    def _sync_draft(self, slot, accepted, proposed):
+        # The draft evaluated its own proposals except the last one
+        valid = slot.draft_base + min(accepted, max(proposed - 1, 0))
+        _kv_seq_rm(self._draft_ctx, slot.seq_id, valid, -1)
+        slot.draft_n_past = valid
+
+    # --- results ---
+
+    def _accept(self, slot, token):
+        """Handle one sampled token; returns False once the request has finished."""
+        request = slot.request
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+        if token == self._eos:
+            self._finish(slot, "stop")
+            return False
+        slot.n_generated += 1
+        slot.generated.append(token)
+        request.n_generated = slot.n_generated
+        self._tokens_generated += 1
+        piece = slot.decoder.decode(self.llm.detokenize([token]))
+        if slot.n_generated == 1:
+            piece = piece.lstrip()
+        text, slot.tail, hit = split_at_stop(slot.tail + piece, request.stop)
+        if text:
+            request._push(text)
+        if hit:
+            self._finish(slot, "stop")
+        elif slot.n_generated >= request.max_tokens or slot.n_past + 1 >= self.n_ctx:
+            self._finish(slot, "length")
+        else:
+            slot.pending = [token]
+            return True
+        return False
+
+    def _finish(self, slot, reason, error=None):
+        if slot.tail and reason in ("stop", "length"):
+            slot.request._push(slot.tail)
+            slot.tail = ""
+        if self.session_cache is not None and slot.request.session_id is not None and reason in ("stop", "length"):
+            self._save_session(slot)
+        _kv_seq_rm(self._ctx, slot.seq_id, -1, -1)
+        if self._draft_ctx is not None:
+            _kv_seq_rm(self._draft_ctx, slot.seq_id, -1, -1)
+        self._active.remove(slot)
+        self._free.append(slot.seq_id)
+        self._requests_completed += 1
+        if reason == "cancelled":
+            self._requests_cancelled += 1
+        self._pending.record_service(time.time() - slot.admitted_at)
+        slot.request._finish(reason, error)
+
+    def _save_session(self, slot):
+        # The last sampled token is only evaluated if generation continued past it
+        tokens = (slot.request.prompt_tokens + slot.generated)[:slot.n_past]
+        try:
+            self.session_cache.put(slot.request.session_id, save_sequence(self._ctx, slot.seq_id, tokens))
+        except RuntimeError as e:
+            logger.warning("Could not cache session %s: %s", slot.request.session_id, e)
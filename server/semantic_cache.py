@@ -0,0 +1,174 @@
+"""
+Semantic response cache.
+
+Every generated answer is stored in a dedicated Chroma collection, keyed by
+the embedding of the question that produced it. A later question whose
+embedding is close enough (cosine similarity at or above the threshold)
+gets the stored answer back without touching the model, so paraphrased
+repeats are answered in milliseconds.
+
+Entries are scoped by everything else that shapes an answer (model, mode,
+preferences, RAG), expire after a TTL, and are evicted oldest first past a
+size limit. The whole cache is dropped whenever the knowledge base version
+changes, since answers may have been grounded in the old documents.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import chromadb
+from chromadb.utils import embedding_functions
+
+logger = logging.getLogger(__name__)
+
+
+def read_kb_version(path):
+    """Current knowledge base version stamp ("" if it was never bumped)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def bump_kb_version(path):
+    """Record that the knowledge base changed; call after every ingest, write or restore."""
+    version = str(time.time_ns())
+    # Per-process tmp name: the server and the CLI may bump at the same time
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+    return version
+
+
+def cache_scope(**options):
+    """Stable hash of the request options an answer depends on."""
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class SemanticCache:
+    """
+    Answer cache looked up by query embedding similarity.
+
+    Args:
+        path: Directory of the cache's own Chroma database
+        kb_version_path: Knowledge base version file; a change clears the cache
+        embed: Function mapping a list of texts to vectors (defaults to Chroma's embedder)
+        threshold: Minimum cosine similarity for a hit
+        ttl: Seconds an answer stays valid
+        max_entries: Entries kept before the oldest are evicted
+    """
+
+    COLLECTION = "response_cache"
+
+    def __init__(self, path, kb_version_path, embed=None, threshold=0.92, ttl=7 * 24 * 3600, max_entries=5000):
+        self.kb_version_path = kb_version_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._embed = embed or embedding_functions.DefaultEmbeddingFunction()
+        self._client = chromadb.PersistentClient(path=path)
+        self._lock = threading.Lock()
+        self._collection = self._open()
+        self._kb_version = self._collection.metadata.get("kb_version", "") if self._collection.metadata else ""
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _open(self, kb_version=None):
+        metadata = {"hnsw:space": "cosine"}
+        if kb_version is not None:
+            metadata["kb_version"] = kb_version
+        return self._client.get_or_create_collection(self.COLLECTION, metadata=metadata)
+
+    def embed(self, text):
+        return [float(x) for x in self._embed([text])[0]]
+
+    def get(self, embedding, scope):
+        """Return the cached answer for a query embedding, or None."""
+        self._check_kb_version()
+        if self._collection.count() == 0:
+            self.misses += 1
+            return None
+        results = self._collection.query(query_embeddings=[embedding], n_results=1, where={"scope": scope},
+                                         include=["metadatas", "distances"])
+        ids = results.get("ids", [[]])[0]
+        if not ids:
+            self.misses += 1
+            return None
+        meta = results["metadatas"][0][0]
+        # Cosine space: distance = 1 - similarity
+        similarity = 1.0 - results["distances"][0][0]
+        if similarity < self.threshold:
+            self.misses += 1
+            return None
+        if time.time() - meta.get("created_at", 0) > self.ttl:
+            self._collection.delete(ids=[ids[0]])
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta.get("answer")
+
+    def put(self, query, embedding, answer, scope):
+        self._check_kb_version()
+        self._collection.add(
+            ids=[uuid.uuid4().hex],
+            embeddings=[embedding],
+            documents=[query],
+            metadatas=[{"answer": answer, "scope": scope, "created_at": time.time()}],
+        )
+        self._puts += 1
+        # Size checks need a scan, so only do one every so often
+        if self._puts % 100 == 0:
+            self._evict()
+
+    def _evict(self):
+        entries = self._collection.get(include=["metadatas"])
+        now = time.time()
+        aged = sorted(zip(entries["ids"], entries["metadatas"]), key=lambda e: e[1].get("created_at", 0))
+        stale = [i for i, m in aged if now - m.get("created_at", 0) > self.ttl]
+        fresh = [i for i, m in aged if now - m.get("created_at", 0) <= self.ttl]
+        excess = fresh[:max(0, len(fresh) - self.max_entries)]
+        doomed = stale + excess
+        if doomed:
+            self._collection.delete(ids=doomed)
+            self.evictions += len(doomed)
+
+    def _check_kb_version(self):
+        version = read_kb_version(self.kb_version_path)
+        if version != self._kb_version:
+            self.clear(version)
+
+    def clear(self, kb_version=None):
+        """Drop every cached answer (e.g. after the knowledge base changed)."""
+        with self._lock:
+            if kb_version is None:
+                kb_version = read_kb_version(self.kb_version_path)
+            try:
+                self._client.delete_collection(self.COLLECTION)
+            except Exception:
+                pass
+            self._collection = self._open(kb_version)
+            self._kb_version = kb_version
+            self.invalidations += 1
+        logger.info("Response cache cleared (knowledge base version %s)", kb_version or "initial")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._collection.count(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "threshold": self.threshold,
+        }
@@ -0,0 +1,197 @@
+"""
+Per-user session KV cache.
+
+After each turn the scheduler snapshots the user's sequence (prompt plus
+answer). The next turn restores it and only evaluates tokens past the longest
+common prefix, which for a growing conversation is just the new message.
+
+Snapshots live in a bounded in-RAM LRU tier. Entries evicted from RAM are
+spilled by a background thread to files under the cache directory, which are
+memory-mapped when read back and promoted to RAM again.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from server.kv_cache import SequenceSnapshot
+
+logger = logging.getLogger(__name__)
+
+# File layout: uint64 token count, int32 tokens, then the raw sequence state
+_HEADER = struct.Struct("<Q")
+
+
+def common_prefix_length(a, b):
+    """Number of leading tokens two sequences share."""
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = np.flatnonzero(np.asarray(a[:n], dtype=np.int64) != np.asarray(b[:n], dtype=np.int64))
+    return int(diff[0]) if diff.size else n
+
+
+class SessionCache:
+    """
+    Two-tier (RAM LRU, then disk) store of per-session sequence snapshots.
+
+    Args:
+        directory: Where spilled snapshots are written
+        max_ram_bytes: Budget for snapshots kept in memory
+        max_disk_bytes: Budget for spilled snapshots on disk
+    """
+
+    def __init__(self, directory, max_ram_bytes=1 << 30, max_disk_bytes=8 << 30):
+        self.directory = directory
+        self.max_ram_bytes = max_ram_bytes
+        self.max_disk_bytes = max_disk_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._ram = OrderedDict()
+        self._ram_bytes = 0
+        self._spilling = {}
+        self._lock = threading.Lock()
+        self._spill_queue = queue.Queue()
+        self.ram_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spills = 0
+        threading.Thread(target=self._spill_loop, name="session-cache-spill", daemon=True).start()
+
+    def _path(self, session_id):
+        name = hashlib.sha256(str(session_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.kv")
+
+    def get(self, session_id):
+        """Return the session's snapshot from RAM or disk, or None."""
+        with self._lock:
+            snapshot = self._ram.get(session_id)
+            if snapshot is not None:
+                self._ram.move_to_end(session_id)
+                self.ram_hits += 1
+                return snapshot
+            snapshot = self._spilling.get(session_id)
+            if snapshot is not None:
+                self.ram_hits += 1
+        if snapshot is not None:
+            # Evicted but not yet written out; take it back
+            self.put(session_id, snapshot)
+            return snapshot
+        snapshot = self._read(self._path(session_id))
+        with self._lock:
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(session_id, snapshot)
+        return snapshot
+
+    def put(self, session_id, snapshot):
+        with self._lock:
+            self._spilling.pop(session_id, None)
+            old = self._ram.pop(session_id, None)
+            if old is not None:
+                self._ram_bytes -= old.size
+            self._ram[session_id] = snapshot
+            self._ram_bytes += snapshot.size
+            while self._ram_bytes > self.max_ram_bytes and len(self._ram) > 1:
+                evicted_id, evicted = self._ram.popitem(last=False)
+                self._ram_bytes -= evicted.size
+                self._spilling[evicted_id] = evicted
+                self._spill_queue.put(evicted_id)
+
+    def discard(self, session_id):
+        with self._lock:
+            old = self._ram.pop(session_id, None)
+            if old is not None:
+                self._ram_bytes -= old.size
+            self._spilling.pop(session_id, None)
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        lookups = self.ram_hits + self.disk_hits + self.misses
+        return {
+            "ram_entries": len(self._ram),
+            "ram_bytes": self._ram_bytes,
+            "ram_hits": self.ram_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.ram_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "spills": self.spills,
+        }
+
+    # --- disk tier ---
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    (n_tokens,) = _HEADER.unpack_from(mm, 0)
+                    offset = _HEADER.size + 4 * n_tokens
+                    tokens = np.frombuffer(mm, dtype=np.int32, count=n_tokens, offset=_HEADER.size).tolist()
+                    data = mm[offset:]
+            os.utime(path)
+            return SequenceSnapshot(tokens, data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Dropping unreadable session snapshot %s: %s", path, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _write(self, path, snapshot):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(len(snapshot.tokens)))
+            f.write(np.asarray(snapshot.tokens, dtype=np.int32).tobytes())
+            f.write(snapshot.data)
+        os.replace(tmp_path, path)
+
+    def _spill_loop(self):
+        while True:
+            session_id = self._spill_queue.get()
+            with self._lock:
+                snapshot = self._spilling.get(session_id)
+            if snapshot is None:
+                continue
+            try:
+                self._write(self._path(session_id), snapshot)
+                self.spills += 1
+                self._trim_disk()
+            except OSError as e:
+                logger.error("Failed to spill session %s to disk: %s", session_id, e)
+            finally:
+                with self._lock:
+                    if self._spilling.get(session_id) is snapshot:
+                        del self._spilling[session_id]
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".kv"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
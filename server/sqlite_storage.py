@@ -0,0 +1,275 @@
+"""
+Embedded SQLite storage backend.
+
+Keeps the server's key/value, chat history and feedback data in a single
+local file, so a single-box deployment needs no database server. The file
+runs in WAL mode (readers never block the writer), each thread gets its own
+connection, and every hot lookup is served by an index:
+
+- kv: (collection, key) primary key
+- chat_history: (user_id, timestamp) and (timestamp)
+- documents: (collection, timestamp) and (collection, feedback, timestamp)
+
+Chat messages and documents are stored as JSON.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from server.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+_FIELD = re.compile(r"^\w+$")
+_USING_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+# Applied in order; PRAGMA user_version records how many have run
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS kv (
+        collection TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (collection, key)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        message TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS chat_history_user_id_timestamp ON chat_history (user_id, timestamp);
+    CREATE TABLE IF NOT EXISTS documents (
+        id TEXT PRIMARY KEY,
+        collection TEXT NOT NULL,
+        timestamp REAL,
+        body TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS documents_collection_timestamp ON documents (collection, timestamp);
+    CREATE INDEX IF NOT EXISTS documents_feedback_timestamp
+        ON documents (collection, json_extract(body, '$.feedback'), timestamp);
+    """,
+    # Retention: finding the users with old messages
+    """
+    CREATE INDEX IF NOT EXISTS chat_history_timestamp ON chat_history (timestamp);
+    """,
+]
+
+_HOT_QUERIES = {
+    "chat_history.recent": ("SELECT message FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT 10", 1),
+    "chat_history.window": ("SELECT message FROM chat_history WHERE user_id = ? ORDER BY timestamp LIMIT 6", 1),
+    "chat_history.count": ("SELECT COUNT(*) FROM chat_history WHERE user_id = ?", 1),
+    "kv.key": ("SELECT value FROM kv WHERE collection = 'user_info' AND key = 'name'", 0),
+    "feedback.upvoted": ("SELECT body FROM documents WHERE collection = 'feedback' "
+                         "AND json_extract(body, '$.feedback') = 'up' ORDER BY timestamp DESC LIMIT 100", 0),
+}
+
+
+def _index_names(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")
+    return {row[0] for row in rows}
+
+
+def _dumps(value):
+    return json.dumps(value, default=str)
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local SQLite database.
+
+    Args:
+        path: Database file; created with its schema on first use
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # The schema must exist before first use; the report is handed to the first migrate() call
+        self._pending_report = self._apply_schema()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: durable across process crashes, fsync only at checkpoints
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get_value(self, collection, key):
+        row = self._conn().execute("SELECT value FROM kv WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def set_value(self, collection, key, value):
+        self._conn().execute(
+            "INSERT INTO kv (collection, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value",
+            (collection, key, _dumps(value)),
+        )
+
+    def delete_value(self, collection, key):
+        self._conn().execute("DELETE FROM kv WHERE collection = ? AND key = ?", (collection, key))
+
+    def insert_many(self, collection, docs):
+        if not docs:
+            return
+        rows = []
+        for doc in docs:
+            doc = dict(doc)
+            doc_id = str(doc.pop("_id", None) or uuid.uuid4().hex)
+            if collection == "chat_history":
+                rows.append((doc_id, doc.get("user_id"), doc.get("timestamp") or time.time(), _dumps(doc.get("message"))))
+            else:
+                rows.append((doc_id, collection, doc.get("timestamp"), _dumps(doc)))
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            if collection == "chat_history":
+                conn.executemany(
+                    "INSERT OR IGNORE INTO chat_history (id, user_id, timestamp, message) VALUES (?, ?, ?, ?)", rows)
+            else:
+                conn.executemany("INSERT OR IGNORE INTO documents (id, collection, timestamp, body) VALUES (?, ?, ?, ?)",
+                                 rows)
+
+    def count_messages(self, user_id):
+        return self._conn().execute("SELECT COUNT(*) FROM chat_history WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def messages(self, user_id, limit, offset=0, newest_first=False):
+        order = "DESC" if newest_first else "ASC"
+        rows = self._conn().execute(
+            f"SELECT message FROM chat_history WHERE user_id = ? ORDER BY timestamp {order} LIMIT ? OFFSET ?",
+            (user_id, limit, offset),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def documents(self, collection, match=None, newest_first=False, limit=None):
+        sql = "SELECT body FROM documents WHERE collection = ?"
+        params = [collection]
+        for field, value in (match or {}).items():
+            if not _FIELD.match(field):
+                raise ValueError(f"Unsupported field name '{field}'")
+            # Literal path so the expression index on feedback can be used
+            sql += f" AND json_extract(body, '$.{field}') = ?"
+            params.append(value)
+        sql += " ORDER BY timestamp DESC" if newest_first else " ORDER BY rowid"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(row[0]) for row in self._conn().execute(sql, params)]
+
+    def message_users(self, before):
+        rows = self._conn().execute("SELECT DISTINCT user_id FROM chat_history WHERE timestamp < ?", (before,))
+        return [row[0] for row in rows]
+
+    def old_messages(self, user_id, before, limit):
+        rows = self._conn().execute(
+            "SELECT id, timestamp, message FROM chat_history WHERE user_id = ? AND timestamp < ? "
+            "ORDER BY timestamp LIMIT ?",
+            (user_id, before, limit),
+        )
+        return [{"_id": row[0], "timestamp": row[1], "message": json.loads(row[2])} for row in rows]
+
+    def delete_messages(self, ids):
+        ids = list(ids)
+        conn = self._conn()
+        deleted = 0
+        with conn:
+            conn.execute("BEGIN")
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                deleted += conn.execute(
+                    f"DELETE FROM chat_history WHERE id IN ({','.join('?' * len(chunk))})", chunk).rowcount
+        return deleted
+
+    def delete_documents(self, collection, before):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            if collection == "chat_history":
+                return conn.execute("DELETE FROM chat_history WHERE timestamp < ?", (before,)).rowcount
+            return conn.execute("DELETE FROM documents WHERE collection = ? AND timestamp < ?",
+                                (collection, before)).rowcount
+
+    def collection_stats(self):
+        conn = self._conn()
+        stats = {}
+        row = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(message)), 0) FROM chat_history").fetchone()
+        stats["chat_history"] = {"count": row[0], "bytes": row[1]}
+        for collection, count, size in conn.execute(
+                "SELECT collection, COUNT(*), SUM(LENGTH(body)) FROM documents GROUP BY collection"):
+            stats[collection] = {"count": count, "bytes": size}
+        for collection, count, size in conn.execute(
+                "SELECT collection, COUNT(*), SUM(LENGTH(value)) FROM kv GROUP BY collection"):
+            stats[collection] = {"count": count, "bytes": size}
+        return stats
+
+    def migrate(self):
+        report, self._pending_report = self._pending_report, None
+        return report or self._apply_schema()
+
+    def _apply_schema(self):
+        start = time.time()
+        conn = self._conn()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        before = _index_names(conn)
+        applied = {}
+        for number, script in enumerate(SCHEMA[version:], start=version + 1):
+            conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+            applied[f"{number:04d}_schema"] = {"user_version": number}
+            logger.info("Applied SQLite schema version %d to %s", number, self.path)
+        after = _index_names(conn)
+        return {"migrations": applied, "indexes_created": sorted(after - before), "seconds": round(time.time() - start, 3)}
+
+    def explain(self, user_id="default"):
+        report = {}
+        conn = self._conn()
+        for name, (sql, n_params) in _HOT_QUERIES.items():
+            details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, (user_id,) * n_params)]
+            indexes = [m.group(1) for m in map(_USING_INDEX.search, details) if m]
+            report[name] = {
+                "stages": details,
+                "index": indexes[0] if indexes else None,
+                # "SCAN <table>" without an index is a full table scan
+                "collection_scan": any(d.startswith("SCAN") and "INDEX" not in d for d in details),
+                "returned": None,
+                "keys_examined": None,
+                "docs_examined": None,
+                "ms": None,
+            }
+        return report
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "available": True,
+            "path": self.path,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "free_pages": self._conn().execute("PRAGMA freelist_count").fetchone()[0],
+            "connections": len(self._connections),
+        }
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
@@ -0,0 +1,332 @@
+"""
+Storage backends for the server's key/value, chat history and feedback data.
+
+Storage is the interface llm_server.py talks to; a backend is picked by
+configuration with open_storage():
+
+- "mongo": MongoStorage keeps one long-lived, pooled MongoClient. Its
+  background monitor heartbeats the server, and a listener feeds those
+  results into a circuit breaker: once Mongo is unreachable the breaker opens
+  and calls fail at once with StorageUnavailable instead of every caller
+  waiting out a server-selection timeout. The next successful heartbeat
+  closes it again.
+- "sqlite": SQLiteStorage (server/sqlite_storage.py) keeps everything in one
+  local SQLite file in WAL mode, for single-box deployments with no database
+  server.
+"""
+import abc
+import logging
+import threading
+import time
+
+from pymongo import DESCENDING, MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo.monitoring import ServerHeartbeatListener
+
+from server.migrations import explain_hot_queries, run_migrations
+
+logger = logging.getLogger(__name__)
+
+_DUPLICATE_KEY = 11000
+
+
+class StorageUnavailable(RuntimeError):
+    """The storage backend cannot be reached right now."""
+
+
+class Storage(abc.ABC):
+    """
+    What the server needs from a database.
+
+    Key/value collections (memory, context, user_info) hold one value per
+    key. chat_history holds {"user_id", "message", "timestamp"} documents and
+    other collections (feedback, corrections) arbitrary documents with a
+    timestamp. Documents may carry an "_id"; inserting one whose _id is
+    already stored is a no-op, so retried writes are not duplicated.
+    """
+
+    name = None
+
+    @property
+    def available(self):
+        return True
+
+    @abc.abstractmethod
+    def get_value(self, collection, key):
+        """The value stored under key, or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_value(self, collection, key, value):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_value(self, collection, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_many(self, collection, docs):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count_messages(self, user_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def messages(self, user_id, limit, offset=0, newest_first=False):
+        """The user's stored chat messages in timestamp order."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def documents(self, collection, match=None, newest_first=False, limit=None):
+        """Documents (without _id) whose top-level fields equal those in match."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def message_users(self, before):
+        """Ids of the users with chat messages older than the `before` timestamp."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def old_messages(self, user_id, before, limit):
+        """The user's oldest messages before `before` as {"_id", "timestamp", "message"}, oldest first."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_messages(self, ids):
+        """Delete chat messages by _id; returns how many were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_documents(self, collection, before):
+        """Delete the collection's documents older than `before`; returns how many were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def collection_stats(self):
+        """{collection: {"count": documents, "bytes": data size}} for the stored collections."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def migrate(self):
+        """Bring the schema and indexes up to date; returns a report dict."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def explain(self, user_id="default"):
+        """Query plans of the hot queries, keyed by query name."""
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures; closes on the next success.
+
+    While open, allow() is False, except that one trial call is let through
+    every `retry_interval` seconds so a missed recovery cannot lock callers out.
+    """
+
+    def __init__(self, failure_threshold=1, retry_interval=5.0):
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._next_trial = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            now = time.time()
+            if now >= self._next_trial:
+                self._next_trial = now + self.retry_interval
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("MongoDB reachable again after %.1fs", time.time() - self.opened_at)
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self._next_trial = self.opened_at + self.retry_interval
+                self.trips += 1
+                logger.error("MongoDB unreachable, failing fast: %s", error)
+
+    def stats(self):
+        return {
+            "open": self.is_open,
+            "open_seconds": round(time.time() - self.opened_at, 1) if self.opened_at else 0.0,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+        }
+
+
+class _HeartbeatListener(ServerHeartbeatListener):
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.last_heartbeat = None
+        self.last_latency_ms = None
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.last_heartbeat = time.time()
+        self.last_latency_ms = round(event.duration * 1000, 2)
+        self.breaker.record_success()
+
+    def failed(self, event):
+        self.last_heartbeat = time.time()
+        self.breaker.record_failure(event.reply)
+
+
+class MongoStorage(Storage):
+    """
+    MongoDB backend with a connection pool and fail-fast health state.
+
+    Args:
+        uri: MongoDB connection string
+        db_name: Database to hand out
+        max_pool_size: Connections kept in the pool
+        heartbeat_ms: How often the background monitor checks the server
+        timeout_ms: Server-selection timeout for operations while healthy
+    """
+
+    name = "mongo"
+
+    def __init__(self, uri, db_name, max_pool_size=50, heartbeat_ms=2000, timeout_ms=2000):
+        self.uri = uri
+        self.db_name = db_name
+        self.breaker = CircuitBreaker(retry_interval=heartbeat_ms / 1000.0)
+        self._listener = _HeartbeatListener(self.breaker)
+        self.client = MongoClient(
+            uri,
+            maxPoolSize=max_pool_size,
+            serverSelectionTimeoutMS=timeout_ms,
+            heartbeatFrequencyMS=max(500, heartbeat_ms),
+            event_listeners=[self._listener],
+        )
+        self.requests = 0
+        self.rejected = 0
+
+    @property
+    def available(self):
+        return not self.breaker.is_open
+
+    def db(self):
+        """The database; raises StorageUnavailable at once while Mongo is known to be down."""
+        self.requests += 1
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise StorageUnavailable("MongoDB unavailable")
+        return self.client[self.db_name]
+
+    def get_value(self, collection, key):
+        doc = self.db()[collection].find_one({"key": key})
+        return doc["value"] if doc else None
+
+    def set_value(self, collection, key, value):
+        self.db()[collection].update_one({"key": key}, {"$set": {"value": value}}, upsert=True)
+
+    def delete_value(self, collection, key):
+        self.db()[collection].delete_one({"key": key})
+
+    def insert_many(self, collection, docs):
+        if not docs:
+            return
+        try:
+            self.db()[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Documents already written by an earlier attempt are fine
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != _DUPLICATE_KEY]
+            if errors or e.details.get("writeConcernErrors"):
+                raise
+
+    def count_messages(self, user_id):
+        return self.db().chat_history.count_documents({"user_id": user_id})
+
+    def messages(self, user_id, limit, offset=0, newest_first=False):
+        cursor = self.db().chat_history.find({"user_id": user_id}, {"message": 1})
+        cursor = cursor.sort("timestamp", DESCENDING if newest_first else 1).skip(offset).limit(limit)
+        return [doc["message"] for doc in cursor]
+
+    def documents(self, collection, match=None, newest_first=False, limit=None):
+        cursor = self.db()[collection].find(match or {}, {"_id": 0})
+        if newest_first:
+            cursor = cursor.sort("timestamp", DESCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def message_users(self, before):
+        return self.db().chat_history.distinct("user_id", {"timestamp": {"$lt": before}})
+
+    def old_messages(self, user_id, before, limit):
+        cursor = self.db().chat_history.find({"user_id": user_id, "timestamp": {"$lt": before}},
+                                             {"timestamp": 1, "message": 1})
+        return list(cursor.sort("timestamp", 1).limit(limit))
+
+    def delete_messages(self, ids):
+        return self.db().chat_history.delete_many({"_id": {"$in": list(ids)}}).deleted_count if ids else 0
+
+    def delete_documents(self, collection, before):
+        return self.db()[collection].delete_many({"timestamp": {"$lt": before}}).deleted_count
+
+    def collection_stats(self):
+        db = self.db()
+        stats = {}
+        for name in db.list_collection_names():
+            info = next(db[name].aggregate([{"$collStats": {"storageStats": {}}}]), {}).get("storageStats", {})
+            stats[name] = {"count": info.get("count", 0), "bytes": info.get("size", 0),
+                           "storage_bytes": info.get("storageSize", 0), "index_bytes": info.get("totalIndexSize", 0)}
+        return stats
+
+    def migrate(self):
+        return run_migrations(self.db())
+
+    def explain(self, user_id="default"):
+        return explain_hot_queries(self.db(), user_id)
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "available": self.available,
+            "requests": self.requests,
+            "fast_failed": self.rejected,
+            "last_heartbeat": self._listener.last_heartbeat,
+            "heartbeat_ms": self._listener.last_latency_ms,
+            "breaker": self.breaker.stats(),
+        }
+
+    def close(self):
+        self.client.close()
+
+
+def open_storage(backend, mongo_uri=None, db_name=None, sqlite_path=None, **mongo_options):
+    """Create the configured backend ("mongo" or "sqlite")."""
+    if backend == "mongo":
+        return MongoStorage(mongo_uri, db_name, **mongo_options)
+    if backend == "sqlite":
+        from server.sqlite_storage import SQLiteStorage
+
+        return SQLiteStorage(sqlite_path)
+    raise ValueError(f"Unknown storage backend '{backend}' (expected 'mongo' or 'sqlite')")
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Rolling per-user conversation summaries.
+
+Instead of pasting an ever-longer window of raw messages into each prompt,
+the server keeps one compact summary per user and sends it with a short
+window of the latest messages, so prompt size stays about the same however
+long a conversation runs.
+
+Summaries are updated incrementally after each turn by a background thread:
+the messages added since the last update are folded into the previous
+summary with a short, background-priority generation. The summary and the
+number of messages it covers are stored under the user's id in the
+"summaries" key/value collection.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from server.user_context import as_chat_message
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_COLLECTION = "summaries"
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the new messages into the current summary. Keep facts about the user, their goals, "
+    "decisions made, open questions and anything the assistant promised. Drop small talk. "
+    "Reply with the updated summary only, written in the third person."
+)
+
+# Longest slice of one message shown to the summarizer
+_MESSAGE_CHARS = 1500
+
+
+def _shifted(state, count):
+    if not state or not state.get("through"):
+        return None
+    return dict(state, through=max(0, state["through"] - count))
+
+
+def shift_summary(storage, user_id, count):
+    """
+    Account for the user's oldest `count` messages leaving chat_history in the
+    stored summary (for offline compaction; the server uses archived()).
+    Returns the new state, or None if the user has no summary.
+    """
+    state = _shifted(storage.get_value(SUMMARY_COLLECTION, user_id), count)
+    if state is not None:
+        storage.set_value(SUMMARY_COLLECTION, user_id, state)
+    return state
+
+
+class ConversationSummarizer:
+    """
+    Folds finished turns into a per-user summary off the request path.
+
+    Args:
+        generate: Function(messages, max_tokens) -> text, run on the summarizer thread
+        storage: Storage backend holding chat_history and the summaries
+        user_context: UserContextCache used to read recent messages and cache summaries
+        keep_messages: Latest messages left out of the summary and sent verbatim
+        max_tokens: Generation budget of one summary
+        batch_messages: Most new messages folded in by one generation
+        max_backlog: Unsummarized messages beyond this are skipped rather than summarized
+        retry_seconds: Delay before retrying a failed update
+    """
+
+    def __init__(self, generate, storage, user_context, keep_messages=2, max_tokens=160, batch_messages=8,
+                 max_backlog=32, retry_seconds=5.0):
+        self.generate = generate
+        self.storage = storage
+        self.user_context = user_context
+        self.keep_messages = keep_messages
+        self.max_tokens = max_tokens
+        self.batch_messages = batch_messages
+        self.max_backlog = max_backlog
+        self.retry_seconds = retry_seconds
+        # user_id -> earliest time to work on it; one entry per user however many turns arrive
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        # Held by update() and archived(); chat_history deletions that call archived() hold it too, so an
+        # update never counts messages on one side of a deletion and stores positions on the other
+        self.lock = threading.RLock()
+        self.updates = 0
+        self.messages_folded = 0
+        self.failures = 0
+        self.update_seconds = 0.0
+        threading.Thread(target=self._run, name="conversation-summarizer", daemon=True).start()
+
+    def state(self, user_id):
+        """{"summary": text, "through": messages covered}, or None before the first update."""
+        return self.user_context.value(SUMMARY_COLLECTION, user_id)
+
+    def schedule(self, user_id, delay=0.0):
+        """Ask for the user's summary to be brought up to date; returns at once."""
+        with self._cond:
+            if user_id not in self._pending:
+                self._pending[user_id] = time.time() + delay
+                self._cond.notify()
+
+    @property
+    def backlog(self):
+        return len(self._pending)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = next((u for u, at in self._pending.items() if at <= now), None)
+                if ready is not None:
+                    del self._pending[ready]
+                    return ready
+                wait = min(self._pending.values()) - now if self._pending else None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            user_id = self._next()
+            try:
+                self.update(user_id)
+            except Exception as e:
+                self.failures += 1
+                logger.warning("Summary update for %s failed, retrying in %.0fs: %s", user_id, self.retry_seconds, e)
+                self.schedule(user_id, delay=self.retry_seconds)
+
+    def update(self, user_id):
+        """Fold every message except the last keep_messages into the user's summary."""
+        with self.lock:
+            self._update(user_id)
+
+    def _update(self, user_id):
+        total, latest = self.user_context.history(user_id)
+        if latest is None:
+            raise RuntimeError("storage unavailable")
+        state = self.state(user_id) or {"summary": "", "through": 0}
+        summary, through = state["summary"], state["through"]
+        if through > total:
+            # History was trimmed since the last update; start over from what is left
+            summary, through = "", 0
+        fold_until = total - self.keep_messages
+        if fold_until <= through:
+            return
+        # A long unsummarized backlog (e.g. history from before summaries existed) is
+        # mostly stale; summarize only its most recent part
+        through = max(through, fold_until - self.max_backlog)
+        first_cached = total - len(latest)
+        if through >= first_cached:
+            pending = latest[through - first_cached:fold_until - first_cached]
+        else:
+            pending = [as_chat_message(m) for m in self.storage.messages(user_id, fold_until - through, offset=through)]
+        for i in range(0, len(pending), self.batch_messages):
+            chunk = pending[i:i + self.batch_messages]
+            start = time.time()
+            summary = self._summarize(summary, chunk)
+            through += len(chunk)
+            state = {"summary": summary, "through": through, "updated_at": time.time()}
+            self.storage.set_value(SUMMARY_COLLECTION, user_id, state)
+            self.user_context.set_value(SUMMARY_COLLECTION, user_id, state)
+            self.updates += 1
+            self.messages_folded += len(chunk)
+            self.update_seconds += time.time() - start
+
+    def archived(self, user_id, count):
+        """
+        Account for the user's oldest `count` messages leaving chat_history.
+
+        Archived messages are the oldest ones, which the summary already
+        covers, so it stays valid and only its message count moves down.
+        """
+        with self.lock:
+            state = _shifted(self.state(user_id), count)
+            if state is None:
+                return
+            self.storage.set_value(SUMMARY_COLLECTION, user_id, state)
+            self.user_context.set_value(SUMMARY_COLLECTION, user_id, state)
+
+    def _summarize(self, summary, messages):
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m['content'][:_MESSAGE_CHARS]}" for m in messages)
+        prompt = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}\n\n"
+                                        f"Updated summary:"},
+        ]
+        return self.generate(prompt, self.max_tokens).strip() or summary
+
+    def stats(self):
+        return {
+            "backlog": self.backlog,
+            "updates": self.updates,
+            "messages_folded": self.messages_folded,
+            "failures": self.failures,
+            "avg_update_seconds": round(self.update_seconds / self.updates, 3) if self.updates else 0.0,
+        }
@@ -0,0 +1,88 @@
+"""
+Token accounting for prompt assembly.
+
+Counts come from the model's real tokenizer and are cached per text by
+content hash, so re-counting the same history and RAG chunks on every
+request is a dictionary lookup.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import llama_cpp
+
+from server.scheduler import render_chat_prompt
+
+
+def load_vocab_tokenizer(model_path):
+    """
+    Return a tokenize(text) function backed only by a GGUF's vocabulary.
+
+    Used where the full model is not loaded in this process (worker-pool mode).
+    """
+    vocab = llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False)
+    return lambda text: vocab.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+
+class TokenCounter:
+    """
+    Cached token counts for texts and chat messages.
+
+    Args:
+        tokenize: Function mapping text to a token list; None falls back to
+            a ~4 characters per token estimate
+        max_entries: Number of distinct texts whose counts are remembered
+    """
+
+    def __init__(self, tokenize=None, max_entries=50000):
+        self._tokenize = tokenize
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Template tokens around one turn ("[INST] ... [/INST]"), measured once
+        probe = "x"
+        self.turn_overhead = max(0, self._count(render_chat_prompt([{"role": "user", "content": probe}])) - self._count(probe))
+
+    def _count(self, text):
+        if self._tokenize is None:
+            return len(text) // 4 + 1
+        return len(self._tokenize(text))
+
+    def count(self, text):
+        if not text:
+            return 0
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        with self._lock:
+            n = self._cache.get(key)
+            if n is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return n
+        n = self._count(text)
+        with self._lock:
+            self._cache[key] = n
+            self.misses += 1
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return n
+
+    def count_message(self, message):
+        return self.count(message.get("content") or "") + self.turn_overhead
+
+    def truncate(self, messages, budget):
+        """Keep the newest messages that fit in `budget` tokens, in their original order."""
+        kept = []
+        used = 0
+        for msg in reversed(messages):
+            n = self.count_message(msg)
+            if used + n > budget:
+                break
+            kept.append(msg)
+            used += n
+        kept.reverse()
+        return kept
+
+    def stats(self):
+        return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
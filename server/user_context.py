@@ -0,0 +1,157 @@
+"""
+In-process cache of the per-user context used to build prompts.
+
+Holds the key/value documents of user_info and context (the user's name,
+preferences, recent topics) and, per user, the total message count plus a
+rolling window of the latest chat messages. Entries are loaded from storage
+on first use and from then on kept current by the write paths (set_value,
+delete_value, append_message) instead of being re-read, so assembling a
+prompt costs no database round trip in the steady state.
+
+Chat messages are written behind, so a user's history is loaded from
+storage plus the messages still queued or spilled in the write buffer.
+"""
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def as_chat_message(msg):
+    """Stored chat_history message -> {"role", "content"}."""
+    if isinstance(msg, dict):
+        return {"role": msg.get("role", "user"), "content": msg.get("content", "")}
+    return {"role": "user", "content": str(msg)}
+
+
+class UserContextCache:
+    """
+    Write-through cache of user profile values and recent chat messages.
+
+    Args:
+        storage: Storage backend the values and messages are loaded from
+        history_window: Latest messages kept per user
+        max_users: Users whose history is kept before the least recently used is dropped
+        write_buffer: WriteBuffer the chat_history inserts go through, if any
+    """
+
+    def __init__(self, storage, history_window=32, max_users=1024, write_buffer=None):
+        self.storage = storage
+        self.write_buffer = write_buffer
+        self.history_window = history_window
+        self.max_users = max_users
+        self._values = {}
+        self._history = OrderedDict()
+        # user_id -> markers of the history loads in progress, flagged when the user changes meanwhile
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def value(self, collection, key, default=None):
+        """The value stored under key in a key/value collection."""
+        with self._lock:
+            value = self._values.get((collection, key), _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                return default if value is None else value
+            self.misses += 1
+        if not self.storage.available:
+            return default
+        value = self.storage.get_value(collection, key)
+        with self._lock:
+            self._values.setdefault((collection, key), value)
+        return default if value is None else value
+
+    def set_value(self, collection, key, value):
+        with self._lock:
+            self._values[(collection, key)] = value
+
+    def delete_value(self, collection, key):
+        with self._lock:
+            self._values[(collection, key)] = None
+
+    def history(self, user_id):
+        """
+        (total message count, latest messages oldest first) for a user.
+
+        The list holds at most history_window messages; returns (0, None) if
+        the user is not cached and storage is unavailable.
+        """
+        with self._lock:
+            entry = self._history.get(user_id)
+            if entry is not None:
+                self._history.move_to_end(user_id)
+                self.hits += 1
+                return entry[0], list(entry[1])
+            self.misses += 1
+            marker = {"stale": False}
+            self._loading.setdefault(user_id, []).append(marker)
+        try:
+            if not self.storage.available:
+                return 0, None
+            total, latest = self._load(user_id)
+            messages = [as_chat_message(msg) for msg in latest]
+            with self._lock:
+                if marker["stale"]:
+                    # A message arrived or was archived during the load and may be missing here
+                    return total, messages
+                # Another request may have loaded this user meanwhile
+                entry = self._history.setdefault(user_id, [total, messages])
+                self._evict()
+                return entry[0], list(entry[1])
+        finally:
+            with self._lock:
+                markers = self._loading[user_id]
+                markers.remove(marker)
+                if not markers:
+                    del self._loading[user_id]
+
+    def _load(self, user_id):
+        """(total, latest stored messages oldest first), counting messages the write buffer holds."""
+
+        def read():
+            return (self.storage.count_messages(user_id),
+                    self.storage.messages(user_id, self.history_window, newest_first=True)[::-1])
+
+        if self.write_buffer is None:
+            return read()
+        (total, latest), buffered = self.write_buffer.read_with_unwritten(read, "chat_history", {"user_id": user_id})
+        # Buffered messages are newer than the stored ones, except spilled ones replayed late
+        latest = latest + [doc["message"] for doc in buffered]
+        return total + len(buffered), latest[-self.history_window:]
+
+    def append_message(self, user_id, message):
+        """Record a message written to chat_history; users not cached are loaded on next use."""
+        with self._lock:
+            entry = self._history.get(user_id)
+            if entry is None:
+                self._mark_stale(user_id)
+                return
+            entry[0] += 1
+            entry[1].append(as_chat_message(message))
+            del entry[1][:-self.history_window]
+
+    def forget_user(self, user_id):
+        """Drop the user's cached history, e.g. after messages were archived; reloaded on next use."""
+        with self._lock:
+            self._history.pop(user_id, None)
+            self._mark_stale(user_id)
+
+    def _mark_stale(self, user_id):
+        for marker in self._loading.get(user_id, ()):
+            marker["stale"] = True
+
+    def _evict(self):
+        while len(self._history) > self.max_users:
+            self._history.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._history),
+            "values": len(self._values),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
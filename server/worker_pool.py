@@ -0,0 +1,316 @@
+"""
+Multi-process model worker pool.
+
+A single 7B context cannot keep a large host busy, so pool mode starts N
+worker processes. Each one loads its own copy of the model, is pinned to a
+disjoint share of the CPU cores and runs its own InferenceScheduler. The
+server process only dispatches: every chat goes to the worker with the fewest
+requests in flight, and tokens come back over that worker's pipe.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import psutil
+from llama_cpp import Llama
+
+from server.admission import PRIORITY_INTERACTIVE, QueueFull, estimate_retry_after, priority_limit
+from server.scheduler import HANDLE_N_CTX, GenerationRequest, InferenceScheduler
+from server.session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+
+def partition_cores(cores, n_workers):
+    """Split a list of core ids into n_workers contiguous, non-overlapping shares."""
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    shares = []
+    start = 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        shares.append(cores[start:end])
+        start = end
+    return shares
+
+
+def _worker_main(conn, model_path, cores, n_ctx, n_slots, n_batch, session_cache_options, draft_model_path, draft_k,
+                 max_queue, model_options):
+    """Entry point of a worker process: load the model, then serve pipe messages."""
+    try:
+        psutil.Process().cpu_affinity(cores)
+    except (AttributeError, psutil.Error, OSError) as e:
+        logger.warning("Could not pin worker %s to cores %s: %s", os.getpid(), cores, e)
+
+    llm = Llama(model_path=model_path, n_ctx=HANDLE_N_CTX, n_threads=len(cores), n_threads_batch=len(cores), verbose=False,
+                **model_options)
+    draft_llm = None
+    if draft_model_path:
+        draft_llm = Llama(model_path=draft_model_path, n_ctx=HANDLE_N_CTX, n_threads=len(cores),
+                          n_threads_batch=len(cores), verbose=False, **model_options)
+    # Workers share the on-disk session tier; each keeps its own RAM tier
+    session_cache = SessionCache(**session_cache_options) if session_cache_options else None
+    scheduler = InferenceScheduler(llm, n_slots=n_slots, n_ctx=n_ctx, n_batch=n_batch, session_cache=session_cache,
+                                   draft_llm=draft_llm, draft_k=draft_k, max_queue=max_queue)
+    send_lock = threading.Lock()
+    generations = {}
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def relay(request_id, generation):
+        try:
+            for text in generation:
+                send(("token", request_id, text))
+            send(("done", request_id, generation.finish_reason, None))
+        except Exception as e:
+            # Keep "expired" (admission deadline passed) so the server can still answer 429
+            send(("done", request_id, generation.finish_reason or "error", str(e)))
+        finally:
+            generations.pop(request_id, None)
+
+    send(("ready", os.getpid()))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        kind = message[0]
+        if kind == "submit":
+            _, request_id, kwargs = message
+            try:
+                generation = scheduler.submit(**kwargs)
+            except QueueFull as e:
+                send(("done", request_id, "rejected", str(e)))
+                continue
+            except Exception as e:
+                # A bad request must not take the worker, and everything it serves, down
+                logger.error("Submitting request %s failed: %s", request_id, e, exc_info=True)
+                send(("done", request_id, "error", str(e)))
+                continue
+            generations[request_id] = generation
+            threading.Thread(target=relay, args=(request_id, generation), daemon=True).start()
+        elif kind == "cancel":
+            generation = generations.get(message[1])
+            if generation is not None:
+                generation.cancel()
+        elif kind == "stats":
+            send(("stats", scheduler.stats()))
+        elif kind == "stop":
+            break
+    scheduler.close()
+
+
+class _Worker:
+    """Parent-side handle of one worker process."""
+
+    def __init__(self, index, process, conn, cores):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.cores = cores
+        self.pid = None
+        self.ready = False
+        self.alive = True
+        # Set once the worker has loaded its model, or has exited
+        self.started = threading.Event()
+        self.stats = None
+        self.requests = {}
+        self.send_lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return len(self.requests)
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class WorkerPool:
+    """
+    Dispatches generations to pinned model worker processes.
+
+    Exposes the same submit()/stats()/close() surface as InferenceScheduler so
+    the endpoints do not care which one is serving them.
+
+    Args:
+        model_path: GGUF file every worker loads
+        n_workers: Number of worker processes
+        cores: Core ids to partition (defaults to this process's affinity)
+        n_ctx: Context window per sequence
+        n_slots: Concurrent sequences inside each worker
+        n_batch: Per-step token budget inside each worker
+        session_cache_options: SessionCache kwargs for the workers (None disables it)
+        draft_model_path: Optional draft GGUF each worker loads for speculative decoding
+        draft_k: Tokens the draft proposes per step
+        max_queue: Requests allowed to wait for a slot across the pool
+        model_options: Extra Llama kwargs for the main model (e.g. use_mmap, use_mlock)
+    """
+
+    def __init__(self, model_path, n_workers, cores=None, n_ctx=2048, n_slots=2, n_batch=512,
+                 session_cache_options=None, draft_model_path=None, draft_k=4, max_queue=16, model_options=None):
+        if cores is None:
+            try:
+                cores = psutil.Process().cpu_affinity()
+            except (AttributeError, psutil.Error):
+                cores = list(range(os.cpu_count() or 1))
+        mp = multiprocessing.get_context("spawn")
+        self.workers = []
+        self._lock = threading.Lock()
+        self.n_slots = n_slots
+        self.max_queue = max_queue
+        self.rejected = 0
+        self._service_time = 0.0
+        for index, share in enumerate(partition_cores(list(cores), n_workers)):
+            parent_conn, child_conn = mp.Pipe()
+            process = mp.Process(
+                target=_worker_main,
+                args=(child_conn, model_path, share, n_ctx, n_slots, n_batch, session_cache_options,
+                      draft_model_path, draft_k, max_queue, model_options or {}),
+                name=f"meai-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            worker = _Worker(index, process, parent_conn, share)
+            self.workers.append(worker)
+            threading.Thread(target=self._read, args=(worker,), name=f"meai-worker-{index}-reader", daemon=True).start()
+
+    def submit(self, messages=None, max_tokens=256, stop=None, static_prefix=None, session_id=None,
+               priority=PRIORITY_INTERACTIVE, deadline=None, **sampling):
+        """
+        Send a chat to the least-loaded live worker and return its request.
+
+        Raises QueueFull when more requests are already waiting across the
+        pool than the request's priority allows.
+        """
+        request = GenerationRequest([], max_tokens=max_tokens, stop=stop, **sampling)
+        request.priority = priority
+        request.deadline = deadline
+        with self._lock:
+            live = [w for w in self.workers if w.alive]
+            if not live:
+                request._finish("error", RuntimeError("No model workers are running"))
+                return request
+            capacity = len(live) * self.n_slots
+            queued = self._queued(live)
+            if queued >= priority_limit(priority, self.max_queue):
+                self.rejected += 1
+                raise QueueFull(estimate_retry_after(queued, capacity, self._service_time))
+            worker = min(live, key=lambda w: w.in_flight)
+            worker.requests[request.id] = request
+        request._on_cancel = lambda: self._cancel(worker, request.id)
+        kwargs = dict(messages=messages, max_tokens=max_tokens, stop=stop, static_prefix=static_prefix,
+                      session_id=session_id, priority=priority, deadline=deadline, **sampling)
+        try:
+            worker.send(("submit", request.id, kwargs))
+        except (OSError, EOFError) as e:
+            with self._lock:
+                worker.requests.pop(request.id, None)
+            request._finish("error", RuntimeError(f"Worker {worker.index} is unreachable: {e}"))
+        return request
+
+    def _queued(self, workers):
+        return sum(max(0, w.in_flight - self.n_slots) for w in workers)
+
+    def _cancel(self, worker, request_id):
+        self._send_quietly(worker, ("cancel", request_id))
+
+    def _send_quietly(self, worker, message):
+        try:
+            worker.send(message)
+        except (OSError, EOFError):
+            pass
+
+    def _read(self, worker):
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "ready":
+                worker.pid = message[1]
+                worker.ready = True
+                worker.started.set()
+                logger.info("Model worker %s ready (pid %s, cores %s)", worker.index, worker.pid, worker.cores)
+            elif kind == "stats":
+                worker.stats = message[1]
+            elif kind == "token":
+                request = worker.requests.get(message[1])
+                if request is not None:
+                    request._push(message[2])
+            elif kind == "done":
+                _, request_id, reason, error = message
+                with self._lock:
+                    request = worker.requests.pop(request_id, None)
+                if request is not None:
+                    request._finish(reason, RuntimeError(error) if error else None)
+                    if reason in ("stop", "length"):
+                        elapsed = request.finished_at - request.submitted_at
+                        self._service_time = 0.9 * self._service_time + 0.1 * elapsed if self._service_time else elapsed
+        worker.alive = False
+        worker.started.set()
+        with self._lock:
+            orphaned = list(worker.requests.values())
+            worker.requests.clear()
+        for request in orphaned:
+            request._finish("error", RuntimeError(f"Model worker {worker.index} exited"))
+        logger.error("Model worker %s exited", worker.index)
+
+    @property
+    def ready(self):
+        return any(w.ready and w.alive for w in self.workers)
+
+    def wait_ready(self, timeout=None):
+        """Block until every worker has loaded its model or exited; returns whether any is serving."""
+        deadline = time.time() + timeout if timeout is not None else None
+        for worker in self.workers:
+            worker.started.wait(None if deadline is None else max(0.0, deadline - time.time()))
+        return self.ready
+
+    def stats(self):
+        """Pool state plus each worker's most recent scheduler stats (refreshed asynchronously)."""
+        for worker in self.workers:
+            if worker.alive and worker.ready:
+                self._send_quietly(worker, ("stats",))
+        live = [w for w in self.workers if w.alive]
+        waits = [w.stats["queue"]["wait_ms_avg"] for w in live if w.stats and "queue" in w.stats]
+        queued = self._queued(live)
+        return {
+            "workers": [
+                {
+                    "index": w.index,
+                    "pid": w.pid,
+                    "cores": w.cores,
+                    "ready": w.ready,
+                    "alive": w.alive,
+                    "in_flight": w.in_flight,
+                    "scheduler": w.stats,
+                }
+                for w in self.workers
+            ],
+            "in_flight": sum(w.in_flight for w in self.workers),
+            "queue": {
+                "depth": queued,
+                "max_depth": self.max_queue,
+                "rejected": self.rejected,
+                "wait_ms_avg": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "retry_after": estimate_retry_after(queued, len(live) * self.n_slots, self._service_time),
+            },
+        }
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.send(("stop",))
+            except (OSError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
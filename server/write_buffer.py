@@ -0,0 +1,231 @@
+"""
+Write-behind buffer for storage inserts.
+
+Chat history and feedback writes are queued instead of being inserted on the
+request path. A background thread groups whatever arrives within a short
+window (or up to a batch size) into one insert_many per collection. When the
+database is down, batches are appended to a local JSON-lines spill file, and
+the file is replayed once it is reachable again. Every document gets its _id
+when queued, so a batch that is retried or replayed twice is not duplicated.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from bson import ObjectId, json_util
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBuffer:
+    """
+    Batches inserts in the background and spills them to disk while the database is down.
+
+    Args:
+        storage: Storage backend the documents are inserted into
+        spill_path: Append-only file holding writes that could not be delivered
+        max_batch: Most documents written in one flush
+        flush_ms: Longest a queued document waits before its batch is written
+        replay_interval: Seconds between attempts to replay the spill file
+    """
+
+    def __init__(self, storage, spill_path, max_batch=100, flush_ms=200, replay_interval=5.0):
+        self.storage = storage
+        self.spill_path = spill_path
+        self.max_batch = max_batch
+        self.flush_wait = flush_ms / 1000.0
+        self.replay_interval = replay_interval
+        self._queue = queue.Queue()
+        self._spill_lock = threading.Lock()
+        # Held while documents move out of the buffer (into storage or the spill file)
+        self._write_lock = threading.Lock()
+        # _id -> (collection, doc) of queued documents not written or spilled yet
+        self._unwritten = {}
+        self._unwritten_lock = threading.Lock()
+        self._next_replay = 0.0
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self._thread = threading.Thread(target=self._run, name="storage-write-behind", daemon=True)
+        self._thread.start()
+
+    def insert(self, collection, doc):
+        """Queue one document for insertion; returns at once."""
+        doc = dict(doc)
+        doc.setdefault("_id", ObjectId())
+        self.queued += 1
+        with self._unwritten_lock:
+            self._unwritten[doc["_id"]] = (collection, doc)
+        self._queue.put((collection, doc))
+
+    def insert_many(self, collection, docs):
+        for doc in docs:
+            self.insert(collection, doc)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def read_with_unwritten(self, read, collection, match):
+        """
+        Call read() and collect the documents of collection not in storage yet
+        (queued or spilled) whose fields equal those in match.
+
+        No buffered write lands in storage meanwhile, so each document is in
+        exactly one of the two. Returns (read()'s result, documents by timestamp).
+        """
+        with self._write_lock:
+            result = read()
+            with self._unwritten_lock:
+                docs = [doc for name, doc in self._unwritten.values() if name == collection]
+            docs += self._spilled(collection)
+        docs = [doc for doc in docs if all(doc.get(field) == value for field, value in match.items())]
+        return result, sorted(docs, key=lambda doc: doc.get("timestamp", 0))
+
+    def _spilled(self, collection):
+        docs = []
+        with self._spill_lock:
+            for path in (self.spill_path + ".replay", self.spill_path):
+                if not os.path.exists(path):
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json_util.loads(line)
+                        except ValueError:
+                            continue
+                        if entry.get("collection") == collection:
+                            docs.append(entry["doc"])
+        return docs
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.replay_interval)
+            except queue.Empty:
+                self._maybe_replay()
+                continue
+            batch = []
+            deadline = time.time() + self.flush_wait
+            while True:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.max_batch:
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if stopping:
+                # Drain whatever was queued behind the stop marker
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch:
+                self._flush(batch)
+            self._maybe_replay()
+
+    def _flush(self, batch):
+        by_collection = defaultdict(list)
+        for collection, doc in batch:
+            by_collection[collection].append(doc)
+        for collection, docs in by_collection.items():
+            with self._write_lock:
+                self._write(collection, docs)
+                with self._unwritten_lock:
+                    for doc in docs:
+                        self._unwritten.pop(doc["_id"], None)
+
+    def _write(self, collection, docs):
+        if self.storage.available:
+            try:
+                self.storage.insert_many(collection, docs)
+                self.batches += 1
+                self.written += len(docs)
+                return
+            except Exception as e:
+                logger.error("Write-behind insert into %s failed: %s", collection, e)
+        self._spill(collection, docs)
+
+    def _spill(self, collection, docs):
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json_util.dumps({"collection": collection, "doc": doc}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.spilled += len(docs)
+        logger.warning("Database unavailable, spilled %d %s writes to %s", len(docs), collection, self.spill_path)
+
+    def _maybe_replay(self):
+        if time.time() < self._next_replay or not os.path.exists(self.spill_path):
+            return
+        self._next_replay = time.time() + self.replay_interval
+        if self.storage.available:
+            self.replay()
+
+    def replay(self):
+        """Insert the spilled writes; whatever still fails is spilled again."""
+        with self._write_lock:
+            return self._replay()
+
+    def _replay(self):
+        replaying = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replaying):
+                if not os.path.exists(self.spill_path):
+                    return 0
+                os.replace(self.spill_path, replaying)
+        by_collection = defaultdict(list)
+        with open(replaying, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json_util.loads(line)
+                    by_collection[entry["collection"]].append(entry["doc"])
+        replayed = 0
+        for collection, docs in by_collection.items():
+            for i in range(0, len(docs), self.max_batch):
+                chunk = docs[i:i + self.max_batch]
+                try:
+                    self.storage.insert_many(collection, chunk)
+                    replayed += len(chunk)
+                except Exception as e:
+                    logger.error("Replaying spilled %s writes failed: %s", collection, e)
+                    self._spill(collection, chunk)
+        os.remove(replaying)
+        self.replayed += replayed
+        if replayed:
+            logger.info("Replayed %d spilled writes from %s", replayed, self.spill_path)
+        return replayed
+
+    def close(self, timeout=10.0):
+        """Flush everything still queued (spilling it if the database is down) and stop."""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "pending": self.pending,
+            "written": self.written,
+            "batches": self.batches,
+            "avg_batch_size": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "spill_file_bytes": os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0,
+        }